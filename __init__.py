@@ -8,6 +8,7 @@ from . import account
 from . import fiscalyear
 from . import account_voucher_ar
 from . import invoice
+from . import ir
 from . import statement
 
 __all__ = ['register']
@@ -17,6 +18,7 @@ def register():
     Pool.register(
         move.Move,
         move.Line,
+        move.Reconciliation,
         account.Configuration,
         account.ConfigurationDefaultVoucher,
         fiscalyear.FiscalYear,
@@ -26,6 +28,9 @@ def register():
         account_voucher_ar.AccountVoucherLineCredits,
         account_voucher_ar.AccountVoucherLineDebits,
         account_voucher_ar.AccountVoucherLinePaymode,
+        account_voucher_ar.PostVouchersStart,
+        account_voucher_ar.PostVouchersResult,
+        ir.Cron,
         module='account_voucher_ar', type_='model')
     Pool.register(
         statement.AccountVoucherPayMode,
@@ -38,6 +43,7 @@ def register():
         fiscalyear.RenewFiscalYear,
         invoice.PayInvoice,
         invoice.CreditInvoice,
+        account_voucher_ar.PostVouchers,
         module='account_voucher_ar', type_='wizard')
     Pool.register(
         account_voucher_ar.AccountVoucherReport,
@@ -1,21 +1,218 @@
 # This file is part of the account_voucher_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime as dt
+import logging
+import time
+import warnings
+import zipfile
+from bisect import bisect_left
 from decimal import Decimal
 from collections import defaultdict, namedtuple
-from itertools import combinations
-
+from io import BytesIO
+from itertools import chain
+from weakref import WeakKeyDictionary
+
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import Workflow, ModelView, ModelSQL, fields, Index
+from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.report import Report
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, In
-from trytond.tools import grouped_slice
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError, UserWarning
 from trytond.i18n import gettext
 
+from .common import (
+    CurrencyConverter, clear_records_cache, process_pool, timing, timing_stats,
+    reset_timing_stats)
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+logger = logging.getLogger(__name__)
+
 _ZERO = Decimal('0.0')
 
+ReconcileResult = namedtuple('Result', ['lines', 'remainder'])
+MoveLinesResult = namedtuple('MoveLinesResult', [
+        'lines', 'line_map', 'writeoff', 'remainder'])
+VoucherView = namedtuple('VoucherView', [
+        'lines', 'lines_credits', 'lines_debits', 'pay_lines'])
+VoucherLineView = namedtuple('VoucherLineView', [
+        'id', 'name', 'amount', 'amount_original', 'amount_original_company',
+        'date', 'date_expire', 'origin'])
+VoucherOriginView = namedtuple('VoucherOriginView', [
+        'invoice_type', 'number', 'reference', 'invoice_date', 'total_amount',
+        'lang'])
+VoucherPayLineView = namedtuple('VoucherPayLineView', [
+        'id', 'pay_mode_name', 'pay_amount'])
+CompanyHeader = namedtuple('CompanyHeader', [
+        'name', 'vat_number', 'address', 'iva_condition'])
+
+
+class _MatchTimeout(Exception):
+    pass
+
+
+def match_amount(amounts, target, max_lines=None, timeout=None):
+    '''
+    Return the indexes of the subset of amounts which sum is the closest to
+    target and the remainder (sum - target).
+    Amounts and target must be integers (e.g. cents). Exact matches with more
+    items are preferred.
+    The search starts from a greedy solution over all the amounts and improves
+    it using meet-in-the-middle over the first max_lines amounts only, the
+    next amounts are only used by the greedy solution. The best solution found
+    is returned after timeout seconds.
+    '''
+    n = len(amounts)
+    if not n:
+        return [], -target
+    if sum(amounts) == target:
+        return list(range(n)), 0
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    def check_deadline():
+        if deadline is not None and time.monotonic() > deadline:
+            raise _MatchTimeout
+
+    # Greedy solution in the given order used as fallback
+    best_indexes, total = [], 0
+    for i, amount in enumerate(amounts):
+        if abs(total + amount - target) < abs(total - target):
+            best_indexes.append(i)
+            total += amount
+    if not best_indexes:
+        best_indexes, total = [0], amounts[0]
+    best = (abs(total - target), -len(best_indexes))
+    best_remainder = total - target
+
+    if max_lines is not None:
+        amounts = amounts[:max_lines]
+        n = len(amounts)
+
+    def enumerate_sums(offset, values):
+        # sum -> (count, mask) keeping the biggest subset for each sum
+        sums = {0: (0, 0)}
+        for i, value in enumerate(values, offset):
+            for j, (sum_, (count, mask)) in enumerate(list(sums.items())):
+                if not j % 1024:
+                    check_deadline()
+                new_sum = sum_ + value
+                if (new_sum not in sums
+                        or sums[new_sum][0] < count + 1):
+                    sums[new_sum] = (count + 1, mask | (1 << i))
+        return sums
+
+    def indexes(mask):
+        return [i for i in range(n) if mask & (1 << i)]
+
+    half = n // 2
+    best_mask = None
+    try:
+        left = enumerate_sums(0, amounts[:half])
+        right = enumerate_sums(half, amounts[half:])
+        right_sums = sorted(right)
+        for j, (sum_, (count, mask)) in enumerate(left.items()):
+            if not j % 1024:
+                check_deadline()
+            position = bisect_left(right_sums, target - sum_)
+            for other in right_sums[max(position - 1, 0):position + 1]:
+                other_count, other_mask = right[other]
+                if not mask and not other_mask:
+                    continue
+                remainder = sum_ + other - target
+                key = (abs(remainder), -(count + other_count))
+                if key < best:
+                    best = key
+                    best_remainder = remainder
+                    best_mask = mask | other_mask
+    except _MatchTimeout:
+        pass
+    if best_mask is not None:
+        best_indexes = indexes(best_mask)
+    return best_indexes, best_remainder
+
+
+def post_vouchers(database_name, user, ids, context=None):
+    '''
+    Post the vouchers in a new transaction retrying on serialization errors.
+    If the vouchers can not be posted together, each voucher is posted in its
+    own transaction.
+    Return the list of posted ids and a dictionary with the error message of
+    each voucher not posted including the errors raised by the commit.
+    '''
+    database_list = Pool.database_list()
+    pool = Pool(database_name)
+    if database_name not in database_list:
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+    Voucher = pool.get('account.voucher')
+    retry = config.getint('database', 'retry')
+
+    count = 0
+    while True:
+        if count:
+            time.sleep(0.02 * count)
+        # The commit happens when leaving the transaction
+        try:
+            with Transaction(new=True).start(
+                    database_name, user, context=context):
+                Voucher.post(Voucher.browse(ids))
+            return list(ids), {}
+        except backend.DatabaseOperationalError:
+            if count < retry:
+                count += 1
+                logger.debug("Retry: %i", count)
+                continue
+            if len(ids) == 1:
+                return [], {ids[0]: "Serialization failure"}
+        except (UserError, UserWarning) as exception:
+            if len(ids) == 1:
+                return [], {ids[0]: exception.message}
+        except Exception as exception:
+            logger.exception("Fail to post vouchers %s", ids)
+            if len(ids) == 1:
+                return [], {ids[0]: str(exception)}
+        break
+
+    posted, errors = [], {}
+    for id_ in ids:
+        voucher_posted, voucher_errors = post_vouchers(
+            database_name, user, [id_], context=context)
+        posted.extend(voucher_posted)
+        errors.update(voucher_errors)
+    return posted, errors
+
+
+def render_vouchers(database_name, user, groups, data, context=None):
+    '''
+    Render the voucher report for each group of ids in a new transaction.
+    Return the list of extension and content of each group.
+    '''
+    database_list = Pool.database_list()
+    pool = Pool(database_name)
+    if database_name not in database_list:
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+    VoucherReport = pool.get('account.voucher', type='report')
+
+    with Transaction(new=True).start(
+            database_name, user, readonly=True, context=context):
+        return VoucherReport.render_groups(groups, data)
+
 
 class AccountVoucherPayMode(ModelSQL, ModelView):
     'Account Voucher Pay Mode'
@@ -36,6 +233,11 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
 
     _states = {'readonly': Eval('state') != 'draft'}
     _states_done = {'readonly': In(Eval('state'), ['posted', 'cancelled'])}
+    _open_items_cache = Cache('account.voucher.open_items',
+        duration=config.getint(
+            'account_voucher_ar', 'open_items_cache', default=60),
+        context=False)
+    _open_items_totals = WeakKeyDictionary()
 
     number = fields.Char('Number', readonly=True, help="Voucher Number")
     party = fields.Many2One('party.party', 'Party', required=True,
@@ -80,12 +282,10 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         ('posted', 'Posted'),
         ('cancelled', 'Cancelled'),
         ], 'State', readonly=True)
-    amount = fields.Function(fields.Numeric('Payment', digits=(16, 2)),
-        'on_change_with_amount')
-    amount_to_pay = fields.Function(fields.Numeric('To Pay', digits=(16, 2)),
-        'on_change_with_amount_to_pay')
-    amount_invoices = fields.Function(fields.Numeric('Invoices',
-        digits=(16, 2)), 'on_change_with_amount_invoices')
+    amount = fields.Numeric('Payment', digits=(16, 2), readonly=True)
+    amount_to_pay = fields.Numeric('To Pay', digits=(16, 2), readonly=True)
+    amount_invoices = fields.Numeric('Invoices', digits=(16, 2),
+        readonly=True)
     move = fields.Many2One('account.move', 'Move', readonly=True)
     move_cancelled = fields.Many2One('account.move', 'Move Cancelled',
         readonly=True, states={'invisible': ~Eval('move_cancelled')})
@@ -95,6 +295,29 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         states=_states_done)
     writeoff_description = fields.Char('Write Off Description',
         states=_states_done)
+    open_items_order = fields.Selection([
+        ('date', 'Date'),
+        ('maturity_date', 'Maturity Date'),
+        ], 'Open Items Order', required=True, states=_states)
+    open_items_from_date = fields.Date('From Date', states=_states,
+        help="Load only the open items from this date.")
+    open_items_to_date = fields.Date('To Date', states=_states,
+        help="Load only the open items until this date.")
+    open_items_maturity_date = fields.Date('Maturity Cut-off',
+        states=_states,
+        help="Load only the open items due until this date.")
+    open_items_min_amount = fields.Numeric('Minimal Amount',
+        digits=(16, 2), states=_states,
+        help="Load only the open items with at least this residual amount "
+        "in the voucher currency.")
+    open_items_max_amount = fields.Numeric('Maximal Amount',
+        digits=(16, 2), states=_states,
+        help="Load only the open items with at most this residual amount "
+        "in the voucher currency.")
+    open_items_count = fields.Function(fields.Integer('Open Items'),
+        'on_change_with_open_items_count')
+    open_items_total = fields.Function(fields.Numeric('Open Items Total',
+        digits=(16, 2)), 'on_change_with_open_items_total')
 
     del _states, _states_done
 
@@ -112,20 +335,52 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
             'cancel': {
                 'invisible': Eval('state') != 'posted',
                 },
+            'load_lines': {
+                'invisible': Eval('state') != 'draft',
+                'depends': ['state'],
+                },
+            'load_more_lines': {
+                'invisible': Eval('state') != 'draft',
+                'depends': ['state'],
+                },
             })
+        cls.__rpc__.update({
+                'preview_post': RPC(readonly=True, instantiate=0),
+                'get_timing_stats': RPC(readonly=True),
+                })
         cls._order.insert(0, ('date', 'DESC'))
         cls._order.insert(1, ('number', 'DESC'))
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.state, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(t, (t.state, Index.Equality())),
+                Index(
+                    t,
+                    (t.party, Index.Equality()),
+                    (t.state, Index.Equality()),
+                    (t.date, Index.Range())),
+                })
 
     @classmethod
     def __register__(cls, module_name):
+        pool = Pool()
         cursor = Transaction().connection.cursor()
+        table_exist = backend.TableHandler.table_exist(cls._table)
         table_h = cls.__table_handler__(module_name)
         sql_table = cls.__table__()
+        amounts_exist = table_h.column_exist('amount')
         super().__register__(module_name)
+
+        # Migration from 7.0: store amounts
+        # The lines are registered after the voucher on a fresh install
+        lines_exist = all(
+            backend.TableHandler.table_exist(pool.get(n)._table) for n in [
+                'account.voucher.line',
+                'account.voucher.line.credits',
+                'account.voucher.line.debits',
+                'account.voucher.line.paymode',
+                ])
+        if table_exist and not amounts_exist and lines_exist:
+            cursor.execute(*sql_table.update(*cls._amounts_sql(sql_table)))
         cursor.execute(*sql_table.update(
             [sql_table.state], ['cancelled'],
             where=sql_table.state == 'canceled'))
@@ -138,6 +393,22 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
     def default_state():
         return 'draft'
 
+    @classmethod
+    def default_amount(cls):
+        return _ZERO
+
+    @classmethod
+    def default_amount_to_pay(cls):
+        return _ZERO
+
+    @classmethod
+    def default_amount_invoices(cls):
+        return _ZERO
+
+    @classmethod
+    def default_open_items_order(cls):
+        return 'date'
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -176,55 +447,123 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         return currency.id if currency else None
 
     def set_number(self):
+        "Set the number of the voucher using the sequence of its fiscal year"
+        self.set_numbers([self])
+
+    @classmethod
+    def set_numbers(cls, vouchers):
+        '''
+        Set the number of the vouchers using the sequence of their fiscal year
+        in the order of date and id.
+        '''
         pool = Pool()
         FiscalYear = pool.get('account.fiscalyear')
 
-        fiscalyear = FiscalYear.find(self.company, date=self.date)
-        sequence = fiscalyear.get_voucher_sequence(self.voucher_type)
-        if not sequence:
-            raise UserError(gettext(
-                'account_voucher_ar.msg_voucher_no_sequence',
-                voucher=self.rec_name, fiscalyear=fiscalyear.rec_name))
-        self.write([self], {'number': sequence.get()})
+        fiscalyears = {}
+        groups = defaultdict(list)
+        for voucher in vouchers:
+            key = (voucher.company, voucher.date)
+            if key not in fiscalyears:
+                fiscalyears[key] = FiscalYear.find(
+                    voucher.company, date=voucher.date)
+            fiscalyear = fiscalyears[key]
+            groups[(fiscalyear, voucher.voucher_type)].append(voucher)
+
+        to_write = []
+        for (fiscalyear, voucher_type), vouchers in groups.items():
+            sequence = fiscalyear.get_voucher_sequence(voucher_type)
+            vouchers = sorted(vouchers, key=lambda v: (v.date, v.id))
+            if not sequence:
+                raise UserError(gettext(
+                    'account_voucher_ar.msg_voucher_no_sequence',
+                    voucher=vouchers[0].rec_name,
+                    fiscalyear=fiscalyear.rec_name))
+            for voucher in vouchers:
+                to_write.extend(([voucher], {'number': sequence.get()}))
+        if to_write:
+            cls.write(*to_write)
 
     @fields.depends('currency')
     def on_change_with_currency_code(self, name=None):
         if self.currency:
             return self.currency.code
 
-    @fields.depends('party', 'pay_lines', 'lines_credits', 'lines_debits',
-        'currency')
-    def on_change_with_amount(self, name=None):
-        amount = _ZERO
-        if self.pay_lines:
-            for line in self.pay_lines:
-                if line.pay_amount:
-                    amount += line.pay_amount
-        if self.lines_credits:
-            for line in self.lines_credits:
-                if line.amount_original:
-                    amount += line.amount_original
-        if self.lines_debits:
-            for line in self.lines_debits:
-                if line.amount_original:
-                    amount += line.amount_original
-        return amount
+    @fields.depends('pay_lines', 'lines_credits', 'lines_debits', 'lines')
+    def _get_amounts(self):
+        "Return the amounts of the voucher computed in one pass over lines"
+        amount = amount_to_pay = amount_invoices = _ZERO
+        for line in self.pay_lines or []:
+            amount += line.pay_amount or _ZERO
+        for line in list(self.lines_credits or []) + list(
+                self.lines_debits or []):
+            amount += line.amount_original or _ZERO
+        for line in self.lines or []:
+            amount_to_pay += line.amount_unreconciled or _ZERO
+            amount_invoices += line.amount or _ZERO
+        return {
+            'amount': amount,
+            'amount_to_pay': amount_to_pay,
+            'amount_invoices': amount_invoices,
+            }
+
+    @fields.depends(methods=['_get_amounts'])
+    def _set_amounts(self):
+        for name, value in self._get_amounts().items():
+            setattr(self, name, value)
+
+    @fields.depends(methods=['_set_amounts'])
+    def on_change_pay_lines(self):
+        self._set_amounts()
+
+    @fields.depends(methods=['_set_amounts'])
+    def on_change_lines(self):
+        self._set_amounts()
+
+    @fields.depends(methods=['_set_amounts'])
+    def on_change_lines_credits(self):
+        self._set_amounts()
+
+    @fields.depends(methods=['_set_amounts'])
+    def on_change_lines_debits(self):
+        self._set_amounts()
 
-    @fields.depends('party', 'lines', 'currency')
-    def on_change_with_amount_to_pay(self, name=None):
-        total = 0
-        if self.lines:
-            for line in self.lines:
-                total += line.amount_unreconciled or _ZERO
-        return total
+    @classmethod
+    def _amounts_sql(cls, table):
+        "Return the columns and the SQL expressions of the stored amounts"
+        pool = Pool()
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        Line = pool.get('account.voucher.line')
+        LineCredits = pool.get('account.voucher.line.credits')
+        LineDebits = pool.get('account.voucher.line.debits')
+
+        def total(Model, name):
+            line = Model.__table__()
+            return Coalesce(line.select(Sum(getattr(line, name)),
+                    where=line.voucher == table.id), 0)
+
+        columns = [table.amount, table.amount_to_pay, table.amount_invoices]
+        values = [
+            total(PayModeLine, 'pay_amount')
+            + total(LineCredits, 'amount_original')
+            + total(LineDebits, 'amount_original'),
+            total(Line, 'amount_unreconciled'),
+            total(Line, 'amount'),
+            ]
+        return columns, values
 
-    @fields.depends('party', 'lines', 'currency')
-    def on_change_with_amount_invoices(self, name=None):
-        total = Decimal('0')
-        if self.lines:
-            for line in self.lines:
-                total += line.amount or _ZERO
-        return total
+    @classmethod
+    def update_amounts(cls, vouchers):
+        "Update the stored amounts of the vouchers from their lines"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        ids = list({int(v) for v in vouchers})
+        columns, values = cls._amounts_sql(table)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(columns, values,
+                    where=reduce_ids(table.id, sub_ids)))
+        clear_records_cache(cls, ids)
 
     @fields.depends('lines', 'currency', 'company')
     def on_change_with_currency_rate(self, name=None):
@@ -245,71 +584,308 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
             Decimal(str(10 ** -6)))
 
     @fields.depends('party', 'voucher_type', 'lines', 'lines_credits',
-        'lines_debits', 'currency', 'company', 'date', 'pay_invoice')
+        'lines_debits', 'currency', 'company', 'date', 'pay_invoice',
+        methods=['add_lines', '_set_amounts'])
     def on_change_party(self):
         self.add_lines()
+        self._set_amounts()
 
     @fields.depends('party', 'voucher_type', 'lines', 'lines_credits',
-        'lines_debits', 'currency', 'company', 'date', 'pay_invoice')
+        'lines_debits', 'currency', 'company', 'date', 'pay_invoice',
+        methods=['add_lines', '_set_amounts'])
     def on_change_currency(self):
         self.add_lines()
+        self._set_amounts()
 
+    @fields.depends('party', 'voucher_type', 'lines', 'lines_credits',
+        'lines_debits', 'currency', 'company', 'date', 'pay_invoice',
+        'open_items_order', 'open_items_from_date', 'open_items_to_date',
+        'open_items_maturity_date', 'open_items_min_amount',
+        'open_items_max_amount')
     def add_lines(self):
-        pool = Pool()
-        Invoice = pool.get('account.invoice')
-        MoveLine = pool.get('account.move.line')
-        InvoiceAccountMoveLine = pool.get('account.invoice-account.move.line')
-        Currency = pool.get('currency.currency')
-        AccountVoucherLineCredits = pool.get('account.voucher.line.credits')
-        AccountVoucherLineDebits = pool.get('account.voucher.line.debits')
-        AccountVoucherLine = pool.get('account.voucher.line')
-
-        lines = []
-        lines_credits = []
-        lines_debits = []
-
         if not self.currency or not self.party:
-            self.lines = lines
-            self.lines_credits = lines_credits
-            self.lines_debits = lines_debits
+            self.lines = []
+            self.lines_credits = []
+            self.lines_debits = []
             return
 
         if self.lines:
             return
 
-        second_currency = None
-        if self.currency != self.company.currency:
-            second_currency = self.currency
+        lines = self._get_open_items_lines(self.get_open_items())
+        if self.open_items_order == 'date':
+            lines['lines'].sort(key=lambda x: x.date)
+        self.lines = lines['lines']
+        self.lines_credits = lines['lines_credits']
+        self.lines_debits = lines['lines_debits']
+
+    @ModelView.button_change('party', 'voucher_type', 'lines',
+        'lines_credits', 'lines_debits', 'currency', 'company', 'date',
+        'pay_invoice', 'open_items_order', 'open_items_from_date',
+        'open_items_to_date', 'open_items_maturity_date',
+        'open_items_min_amount', 'open_items_max_amount',
+        methods=['add_lines', '_set_amounts'])
+    def load_lines(self):
+        "Reload the voucher lines using the open items filters"
+        self.lines = []
+        self.lines_credits = []
+        self.lines_debits = []
+        self.add_lines()
+        self._set_amounts()
+
+    @ModelView.button_change('party', 'voucher_type', 'lines',
+        'lines_credits', 'lines_debits', 'currency', 'company', 'date',
+        'pay_invoice', 'open_items_order', 'open_items_from_date',
+        'open_items_to_date', 'open_items_maturity_date',
+        'open_items_min_amount', 'open_items_max_amount',
+        methods=['add_lines', '_set_amounts'])
+    def load_more_lines(self):
+        "Append the next page of open items to the voucher lines"
+        if not self.currency or not self.party or self.pay_invoice:
+            return
+        loaded = [
+            l.move_line for l in chain(
+                self.lines or [], self.lines_credits or [],
+                self.lines_debits or [])
+            if l.move_line]
+        after = None
+        if loaded:
+            after = max(loaded, key=self._get_open_items_key)
+        lines = self._get_open_items_lines(self.get_open_items(after=after))
+        self.lines = list(self.lines or []) + lines['lines']
+        self.lines_credits = (
+            list(self.lines_credits or []) + lines['lines_credits'])
+        self.lines_debits = (
+            list(self.lines_debits or []) + lines['lines_debits'])
+        self._set_amounts()
+
+    @classmethod
+    def _get_open_items_lines(cls, items):
+        "Return the voucher lines per field for the open items values"
+        pool = Pool()
+        models = {
+            'lines': pool.get('account.voucher.line'),
+            'lines_credits': pool.get('account.voucher.line.credits'),
+            'lines_debits': pool.get('account.voucher.line.debits'),
+            }
+        lines = {f: [] for f in models}
+        for item in items:
+            values = item.copy()
+            field = values.pop('field')
+            lines[field].append(models[field](**values))
+        return lines
+
+    def get_open_items(self, after=None):
+        '''
+        Return the values of the voucher lines for the open items of the party.
+        The open items are filtered and ordered according to the voucher and
+        limited to open_items_page_size lines which come after the move line
+        after in this order.
+        The values of the first page are cached per company, party, type,
+        currency, date and filters until move lines are posted, reconciled
+        or unreconciled.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
 
-        clause = [
+        if self.pay_invoice:
+            return self._get_open_items(self.pay_invoice.lines_to_pay)
+
+        domain = self._get_open_items_domain()
+        if after:
+            domain.append(self._get_open_items_after_domain(after))
+        limit = config.getint(
+            'account_voucher_ar', 'open_items_page_size', default=100) or None
+
+        key = None
+        if not after:
+            key = (Transaction().user, self.company.id, self.party.id,
+                self.voucher_type, self.currency.id, self.date,
+                self.open_items_order, self.open_items_from_date,
+                self.open_items_to_date, self.open_items_maturity_date,
+                self.open_items_min_amount, self.open_items_max_amount,
+                limit)
+            items = self._open_items_cache.get(key)
+            if items is not None:
+                return items
+        items = self._get_open_items(MoveLine.search(domain,
+                order=self._get_open_items_order(), limit=limit))
+        if key is not None:
+            self._open_items_cache.set(key, items)
+        return items
+
+    def _get_open_items_domain(self):
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        domain = [
             ('party', '=', self.party),
             ('state', '=', 'valid'),
             ('reconciliation', '=', None),
             ('move.state', '=', 'posted'),
+            ('invoice_payments', '=', None),
             ]
         if self.voucher_type == 'receipt':
-            clause.append(('account.type.receivable', '=', True))
+            domain.append(('account.type.receivable', '=', True))
         else:
-            clause.append(('account.type.payable', '=', True))
+            domain.append(('account.type.payable', '=', True))
+        domain.append(['OR'] + [
+                ('move.origin', 'like', model + ',%')
+                for model in self._get_open_items_origins()])
+        if self.open_items_from_date:
+            domain.append(('date', '>=', self.open_items_from_date))
+        if self.open_items_to_date:
+            domain.append(('date', '<=', self.open_items_to_date))
+        if self.open_items_maturity_date:
+            domain.append(['OR',
+                    ('maturity_date', '<=', self.open_items_maturity_date),
+                    ('maturity_date', '=', None),
+                    ])
+        if (self.open_items_min_amount is not None
+                or self.open_items_max_amount is not None):
+            residual = MoveLine._amount_residual_query()
+            amount = Abs(self._get_open_items_residual(residual))
+
+            def value(amount):
+                # SQLite uses float for arithmetic
+                if backend.name == 'sqlite':
+                    return float(amount)
+                return amount
+
+            where = Literal(True)
+            if self.open_items_min_amount is not None:
+                where &= amount >= value(self.open_items_min_amount)
+            if self.open_items_max_amount is not None:
+                where &= amount <= value(self.open_items_max_amount)
+            domain.append(
+                ('id', 'in', residual.select(residual.id, where=where)))
+        return domain
+
+    def _get_open_items_residual(self, residual):
+        "Return the column of the residual query in the voucher currency"
+        if (self.currency and self.company
+                and self.currency != self.company.currency):
+            return residual.amount_residual_second_currency
+        return residual.amount_residual
+
+    @classmethod
+    def _get_open_items_origins(cls):
+        "Return the origin models of the moves of the open items"
+        return ['account.invoice', 'account.voucher', 'account.statement']
+
+    def _get_open_items_order(self):
+        if self.open_items_order == 'maturity_date':
+            return [
+                ('maturity_date', 'ASC NULLS FIRST'),
+                ('date', 'ASC'),
+                ('id', 'ASC'),
+                ]
+        return [('date', 'ASC'), ('id', 'ASC')]
+
+    def _get_open_items_key(self, line):
+        "Return the key of the move line in the order of the open items"
+        if self.open_items_order == 'maturity_date':
+            return (line.maturity_date is not None,
+                line.maturity_date or dt.date.min, line.date, line.id)
+        return (line.date, line.id)
+
+    def _get_open_items_after_domain(self, line):
+        "Return the domain of the open items after the move line"
+        after_date = ['OR',
+            ('date', '>', line.date),
+            [('date', '=', line.date), ('id', '>', line.id)],
+            ]
+        if self.open_items_order != 'maturity_date':
+            return after_date
+        if line.maturity_date is None:
+            return ['OR',
+                ('maturity_date', '!=', None),
+                [('maturity_date', '=', None), after_date],
+                ]
+        return ['OR',
+            ('maturity_date', '>', line.maturity_date),
+            [('maturity_date', '=', line.maturity_date), after_date],
+            ]
+
+    @fields.depends(methods=['_get_open_items_totals'])
+    def on_change_with_open_items_count(self, name=None):
+        return self._get_open_items_totals()[0]
+
+    @fields.depends(methods=['_get_open_items_totals'])
+    def on_change_with_open_items_total(self, name=None):
+        return self._get_open_items_totals()[1]
 
+    @fields.depends('party', 'voucher_type', 'currency', 'company', 'date',
+        'pay_invoice', 'state', 'open_items_from_date',
+        'open_items_to_date', 'open_items_maturity_date',
+        'open_items_min_amount', 'open_items_max_amount')
+    def _get_open_items_totals(self):
+        '''
+        Return the number and the total residual amount in the voucher
+        currency of the open items matching the filters computed in SQL
+        with the same residual amounts as the voucher lines.
+        The result is kept for the transaction until a record is modified,
+        so open_items_count and open_items_total are computed once.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if (not self.party or not self.currency or not self.company
+                or self.state not in {None, 'draft'}):
+            return 0, _ZERO
+
+        key = (transaction.user, self.party.id, self.voucher_type,
+            self.currency.id, self.company.id, self.date,
+            self.pay_invoice.id if self.pay_invoice else None,
+            self.open_items_from_date, self.open_items_to_date,
+            self.open_items_maturity_date, self.open_items_min_amount,
+            self.open_items_max_amount)
+        counter, totals = self._open_items_totals.get(transaction, (None, {}))
+        if counter != transaction.counter:
+            totals = {}
+            self._open_items_totals[transaction] = (
+                transaction.counter, totals)
+        if key in totals:
+            return totals[key]
+
+        domain = self._get_open_items_domain()
         if self.pay_invoice:
-            move_lines = self.pay_invoice.lines_to_pay
+            domain.append(('id', 'in',
+                    [l.id for l in self.pay_invoice.lines_to_pay]))
+        residual = MoveLine._amount_residual_query()
+        amount = self._get_open_items_residual(residual)
+        if self.voucher_type == 'receipt':
+            sign = Case((residual.credit > residual.debit, -1), else_=1)
         else:
-            move_lines = MoveLine.search(clause)
+            sign = Case((residual.debit > residual.credit, -1), else_=1)
+        cursor.execute(*residual.select(
+                Count(residual.id),
+                Sum(amount * sign),
+                where=residual.id.in_(MoveLine.search(domain, query=True))))
+        count, total = cursor.fetchone()
+        # SQLite uses float for SUM
+        if total is not None and not isinstance(total, Decimal):
+            total = Decimal(str(total))
+        totals[key] = count, total or _ZERO
+        return totals[key]
+
+    def _get_open_items(self, move_lines):
+        second_currency = None
+        if self.currency != self.company.currency:
+            second_currency = self.currency
 
+        items = []
+        converter = CurrencyConverter()
+        origin_models = self._get_open_items_origins()
+        data = self._get_move_lines_data(move_lines)
         for line in move_lines:
-            origin = str(line.move_origin)
-            origin = origin[:origin.find(',')]
-            if origin not in [
-                    'account.invoice',
-                    'account.voucher',
-                    'account.statement']:
+            origin = data['origins'].get(line.id)
+            if origin not in origin_models:
                 continue
 
-            invoice = InvoiceAccountMoveLine.search([
-                ('line', '=', line.id),
-                ])
-            if invoice:
+            if line.id in data['payment_lines']:
                 continue
 
             if line.credit:
@@ -319,60 +895,103 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 amount = line.debit
                 line_type = 'dr'
 
-            amount_residual = abs(line.amount_residual)
+            residuals = data['residuals'][line.id]
+            amount_residual = abs(residuals['amount_residual'])
             currency_rate = None
             if second_currency:
                 if line.second_currency == self.currency:
                     currency_rate = Decimal(
                         amount / abs(line.amount_second_currency)).quantize(
                         Decimal(str(10 ** -6)))
-                with Transaction().set_context(
-                        currency_rate=currency_rate, date=self.date):
-                    amount = Currency.compute(
-                        self.company.currency, amount,
-                        self.currency)
-                    amount_residual = abs(line.amount_residual_second_currency)
-                    #amount_residual = Currency.compute(
-                        #self.company.currency, amount_residual,
-                        #self.currency)
+                amount = converter.compute(
+                    self.company.currency, amount, self.currency,
+                    date=self.date, currency_rate=currency_rate)
+                amount_residual = abs(
+                    residuals['amount_residual_second_currency'])
 
             name = ''
-            model = str(line.move_origin)
             invoice_date = None
-            if model[:model.find(',')] == 'account.invoice':
-                invoice = Invoice(line.move_origin.id)
-                invoice_date = invoice.invoice_date
-                if invoice.type[0:3] == 'out':
-                    name = invoice.number
+            if origin == 'account.invoice':
+                invoice = data['invoices'][line.id]
+                invoice_date = invoice['invoice_date']
+                if invoice['type'][0:3] == 'out':
+                    name = invoice['number']
                 else:
-                    name = invoice.reference
+                    name = invoice['reference']
 
             if line.credit and self.voucher_type == 'receipt':
-                payment_line = AccountVoucherLineCredits()
+                field = 'lines_credits'
             elif line.debit and self.voucher_type == 'payment':
-                payment_line = AccountVoucherLineDebits()
+                field = 'lines_debits'
             else:
-                payment_line = AccountVoucherLine()
-            payment_line.name = name
-            payment_line.account = line.account.id
-            payment_line.amount = _ZERO
-            payment_line.amount_original = amount
-            payment_line.amount_unreconciled = amount_residual
-            payment_line.line_type = line_type
-            payment_line.move_line = line.id
-            payment_line.date = invoice_date or line.date
-            payment_line.currency_rate = currency_rate
+                field = 'lines'
+            items.append({
+                    'field': field,
+                    'name': name,
+                    'account': line.account.id,
+                    'amount': _ZERO,
+                    'amount_original': amount,
+                    'amount_unreconciled': amount_residual,
+                    'line_type': line_type,
+                    'move_line': line.id,
+                    'date': invoice_date or line.date,
+                    'currency_rate': currency_rate,
+                    })
+        return items
 
-            if line.credit and self.voucher_type == 'receipt':
-                lines_credits.append(payment_line)
-            elif line.debit and self.voucher_type == 'payment':
-                lines_debits.append(payment_line)
-            else:
-                lines.append(payment_line)
+    @classmethod
+    def open_items_cache_stats(cls):
+        "Return the hit and miss counters of the open items cache"
+        return {
+            'hit': cls._open_items_cache.hit,
+            'miss': cls._open_items_cache.miss,
+            }
 
-        self.lines = sorted(lines, key=lambda x: x.date)
-        self.lines_credits = lines_credits
-        self.lines_debits = lines_debits
+    @classmethod
+    def clear_open_items_cache(cls):
+        cls._open_items_cache.clear()
+
+    @classmethod
+    def _get_move_lines_data(cls, move_lines):
+        '''
+        Return the data needed to create voucher lines from move lines using
+        set-based queries:
+            - origins: the origin model of the move of each line
+            - payment_lines: the ids of the lines used as invoice payment
+            - invoices: the invoice values of each line with invoice origin
+            - residuals: the residual amounts of each line
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        InvoiceAccountMoveLine = pool.get('account.invoice-account.move.line')
+        cursor = Transaction().connection.cursor()
+        payment_line = InvoiceAccountMoveLine.__table__()
+
+        ids = [l.id for l in move_lines]
+        payment_lines = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*payment_line.select(payment_line.line,
+                    where=reduce_ids(payment_line.line, sub_ids)))
+            payment_lines.update(l for l, in cursor)
+        origins, invoice_ids = {}, {}
+        for line_id, (model, origin_id) in MoveLine.get_move_origins(
+                ids).items():
+            origins[line_id] = model
+            if model == 'account.invoice':
+                invoice_ids[line_id] = origin_id
+
+        invoices = {i['id']: i for i in Invoice.read(
+                list(set(invoice_ids.values())),
+                ['type', 'number', 'reference', 'invoice_date'])}
+        residuals = {r['id']: r for r in MoveLine.read(ids,
+                ['amount_residual', 'amount_residual_second_currency'])}
+        return {
+            'origins': origins,
+            'payment_lines': payment_lines,
+            'invoices': {l: invoices[i] for l, i in invoice_ids.items()},
+            'residuals': residuals,
+            }
 
     @classmethod
     def delete(cls, vouchers):
@@ -397,30 +1016,46 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         default['lines_debits'] = None
         default['move'] = None
         default['move_cancelled'] = None
+        default['amount'] = _ZERO
+        default['amount_to_pay'] = _ZERO
+        default['amount_invoices'] = _ZERO
         return super().copy(vouchers, default=default)
 
     def prepare_move_lines(self):
-        pool = Pool()
-        Period = pool.get('account.period')
-        Move = pool.get('account.move')
-        Invoice = pool.get('account.invoice')
-        Currency = pool.get('currency.currency')
+        '''
+        Create the move of the voucher and return the values of its lines.
+        Deprecated: create_moves creates the moves of many vouchers at once.
+        '''
+        warnings.warn(
+            "prepare_move_lines is deprecated, use create_moves",
+            DeprecationWarning, stacklevel=2)
+        move = self.get_move()
+        move.save()
+        self.write([self], {'move': move.id})
+        self.move = move
+        move_lines = self.get_move_lines().lines
+        return move_lines
+
+    def get_move_lines(self):
+        '''
+        Return a MoveLinesResult with the values of the move lines, a
+        dictionary with the index of the values generated by each voucher line
+        and the values of the write-off and of the remainder lines if any.
+        The amounts are computed with the CurrencyConverter of the
+        _voucher_converter context key if any.
+        '''
+        converter = (Transaction().context.get('_voucher_converter')
+            or CurrencyConverter())
 
         # Check amount
         if not self.amount > _ZERO:
             raise UserError(gettext(
                 'account_voucher_ar.msg_missing_pay_lines'))
 
-        period = Period.find(self.company, date=self.date)
+        move = self.move or self.get_move()
+        period = move.period
         move_lines = []
-        line_move_ids = []
-        move, = Move.create([{
-            'period': period.id,
-            'journal': self.journal.id,
-            'date': self.date,
-            'origin': str(self),
-            }])
-        self.write([self], {'move': move.id})
+        move_line_map = {}
 
         second_currency = None
         if self.currency != self.company.currency:
@@ -430,15 +1065,15 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         # Pay Modes
         #
         if self.pay_lines:
-            for line in self.pay_lines:
-                amount = line.pay_amount
+            pay_amounts = [l.pay_amount for l in self.pay_lines]
+            if second_currency:
+                pay_amounts = converter.compute_many(self.currency,
+                    pay_amounts, self.company.currency, date=self.date,
+                    currency_rate=self.currency_rate)
+            for line, amount in zip(self.pay_lines, pay_amounts):
                 amount_second_currency = None
                 if second_currency:
-                    amount_second_currency = amount
-                    with Transaction().set_context(
-                            currency_rate=self.currency_rate, date=self.date):
-                        amount = Currency.compute(self.currency,
-                            amount, self.company.currency)
+                    amount_second_currency = line.pay_amount
 
                 if self.voucher_type == 'receipt':
                     if amount < _ZERO:
@@ -482,10 +1117,9 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 amount_second_currency = None
                 if second_currency:
                     amount_second_currency = amount
-                    with Transaction().set_context(
-                            currency_rate=line.currency_rate, date=self.date):
-                        amount = Currency.compute(self.currency,
-                            amount, self.company.currency)
+                    amount = converter.compute(self.currency,
+                        amount, self.company.currency, date=self.date,
+                        currency_rate=line.currency_rate)
 
                 debit = amount
                 credit = _ZERO
@@ -493,6 +1127,7 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 if self.voucher_type == 'payment' and second_currency:
                     amount_second_currency *= -1
 
+                move_line_map[line] = len(move_lines)
                 move_lines.append({
                     'description': 'advance',
                     'debit': debit,
@@ -518,10 +1153,9 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 amount_second_currency = None
                 if second_currency:
                     amount_second_currency = amount
-                    with Transaction().set_context(
-                            currency_rate=line.currency_rate, date=self.date):
-                        amount = Currency.compute(self.currency,
-                            amount, self.company.currency)
+                    amount = converter.compute(self.currency,
+                        amount, self.company.currency, date=self.date,
+                        currency_rate=line.currency_rate)
 
                 debit = _ZERO
                 credit = amount
@@ -529,6 +1163,7 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 if self.voucher_type == 'payment' and second_currency:
                     amount_second_currency *= -1
 
+                move_line_map[line] = len(move_lines)
                 move_lines.append({
                     'description': 'advance',
                     'debit': debit,
@@ -548,20 +1183,18 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         #
         # Voucher Lines
         #
-        with Transaction().set_context(
-                currency_rate=self.currency_rate, date=self.date):
-            total = Currency.compute(self.currency,
-                self.amount, self.company.currency)
-        invoices = 'Factura/s: '
+        total = converter.compute(self.currency,
+            self.amount, self.company.currency, date=self.date,
+            currency_rate=self.currency_rate)
         if self.lines:
+            origins = self._get_lines_origin_models()
             for line in self.lines:
                 if line.amount > line.amount_unreconciled:
                     raise UserError(gettext(
                         'account_voucher_ar.msg_amount_greater_unreconciled'))
 
-                origin = str(line.move_line.move_origin)
-                origin = origin[:origin.find(',')]
-                if origin not in ('account.invoice', 'account.voucher'):
+                if origins.get(line) not in {
+                        'account.invoice', self.__name__}:
                     continue
                 if not line.amount:
                     continue
@@ -570,27 +1203,23 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 amount_second_currency = None
                 if second_currency:
                     amount_second_currency = amount
-                    with Transaction().set_context(
-                            currency_rate=line.currency_rate, date=self.date):
-                        amount = Currency.compute(self.currency,
-                            amount, self.company.currency)
+                    amount = converter.compute(self.currency,
+                        amount, self.company.currency, date=self.date,
+                        currency_rate=line.currency_rate)
 
-                line_move_ids.append(line.move_line)
+                description = self._get_line_description(line)
                 if self.voucher_type == 'receipt':
                     debit = _ZERO
                     credit = amount
-                    description = Invoice(line.move_line.move_origin.id).number
                 else:
                     debit = amount
                     credit = _ZERO
-                    description = Invoice(
-                        line.move_line.move_origin.id).reference
 
                 if self.voucher_type == 'receipt' and second_currency:
                     amount_second_currency *= -1
 
                 total -= amount
-                invoices += description + ', ' if description else ', '
+                move_line_map[line] = len(move_lines)
                 move_lines.append({
                     'description': description,
                     'debit': debit,
@@ -610,6 +1239,7 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
         #
         # Write Off
         #
+        writeoff = remainder = None
         if self.writeoff and total != _ZERO:
             amount = abs(total)
             if self.voucher_type == 'receipt':
@@ -630,10 +1260,11 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                     debit = _ZERO
                     credit = amount
                     writeoff_account = self.writeoff.debit_account
-            description = '%s (%s)' % (self.number,
-                self.writeoff_description or self.writeoff.name)
+            description = self.writeoff_description or self.writeoff.name
+            if self.number:
+                description = '%s (%s)' % (self.number, description)
             party_required = writeoff_account.party_required
-            move_lines.append({
+            writeoff = {
                 'description': description,
                 'debit': debit,
                 'credit': credit,
@@ -644,17 +1275,17 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 'date': self.date,
                 'maturity_date': self.date,
                 'party': party_required and self.party.id or None,
-                })
+                }
+            move_lines.append(writeoff)
             total = _ZERO
 
         if total != _ZERO:
             amount = total
             amount_second_currency = None
             if second_currency:
-                with Transaction().set_context(
-                        currency_rate=self.currency_rate, date=self.date):
-                    amount_second_currency = Currency.compute(
-                        self.company.currency, amount, self.currency)
+                amount_second_currency = converter.compute(
+                    self.company.currency, amount, self.currency,
+                    date=self.date, currency_rate=self.currency_rate)
 
             if self.voucher_type == 'receipt':
                 debit = _ZERO
@@ -670,8 +1301,8 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
             if self.voucher_type == 'receipt' and second_currency:
                 amount_second_currency *= -1
 
-            move_lines.append({
-                'description': self.number,
+            remainder = {
+                'description': self.number or '',
                 'debit': debit,
                 'credit': credit,
                 'account': account.id,
@@ -683,214 +1314,459 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
                 'party': party_required and self.party.id or None,
                 'amount_second_currency': amount_second_currency,
                 'second_currency': second_currency,
-                })
+                }
+            move_lines.append(remainder)
 
-        Move.write([move], {'description': invoices[:-2]})
+        return MoveLinesResult(move_lines, move_line_map, writeoff, remainder)
 
-        return move_lines
+    def get_move(self):
+        pool = Pool()
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+
+        period = Period.find(self.company, date=self.date)
+        return Move(
+            period=period,
+            journal=self.journal,
+            date=self.date,
+            origin=self,
+            description=self.get_move_description(),
+            )
+
+    def get_move_description(self):
+        invoices = 'Factura/s: '
+        origins = self._get_lines_origin_models()
+        for line in self.lines or []:
+            if origins.get(line) not in {'account.invoice', self.__name__}:
+                continue
+            if not line.amount:
+                continue
+            description = self._get_line_description(line)
+            invoices += description + ', ' if description else ', '
+        return invoices[:-2]
+
+    def _get_lines_origin_models(self):
+        "Return the origin model of the move line of each voucher line"
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        lines = [l for l in self.lines or [] if l.move_line]
+        origins = MoveLine.get_move_origins([l.move_line for l in lines])
+        return {
+            l: origins[l.move_line.id][0] for l in lines
+            if l.move_line.id in origins}
+
+    def _get_line_description(self, line):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        origin = line.move_line.move_origin
+        if isinstance(origin, Invoice):
+            if self.voucher_type == 'receipt':
+                return origin.number
+            else:
+                return origin.reference
 
     def create_move(self, move_lines):
+        '''
+        Create the move lines from the values returned by prepare_move_lines,
+        post the move and reconcile its lines.
+        Deprecated: use create_moves.
+        '''
         pool = Pool()
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
-        Invoice = pool.get('account.invoice')
-        Currency = pool.get('currency.currency')
+        warnings.warn(
+            "create_move is deprecated, use create_moves",
+            DeprecationWarning, stacklevel=2)
 
+        converter = CurrencyConverter()
+        with Transaction().set_context(_voucher_converter=converter):
+            move_line_map = self.get_move_lines().line_map
         created_lines = MoveLine.create(move_lines)
         Move.post([self.move])
+        self.reconcile_moves([self], [{
+                    l: created_lines[i] for l, i in move_line_map.items()}],
+            converter=converter)
+        return True
 
+    @classmethod
+    def create_moves(cls, vouchers):
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+
+        with timing('create_moves.moves', vouchers):
+            moves = [v.get_move() for v in vouchers]
+            Move.save(moves)
+            to_write = []
+            for voucher, move in zip(vouchers, moves):
+                to_write.extend(([voucher], {'move': move.id}))
+            if to_write:
+                cls.write(*to_write)
+
+        converter = CurrencyConverter()
+        with timing('create_moves.get_move_lines', vouchers), \
+                Transaction().set_context(_voucher_converter=converter):
+            to_create, move_line_maps = [], []
+            for voucher in vouchers:
+                move_lines, move_line_map, _, _ = voucher.get_move_lines()
+                move_line_maps.append({l: len(to_create) + i
+                        for l, i in move_line_map.items()})
+                to_create.extend(move_lines)
+        with timing('create_moves.create_lines', vouchers):
+            created_lines = MoveLine.create(to_create)
+        with timing('create_moves.post_moves', vouchers):
+            Move.post(moves)
+
+        cls.reconcile_moves(vouchers, [
+                {l: created_lines[i] for l, i in move_line_map.items()}
+                for move_line_map in move_line_maps],
+            converter=converter)
+
+    @classmethod
+    def reconcile_moves(cls, vouchers, move_line_maps, converter=None):
+        '''
+        Add the posted move lines of the vouchers as invoice payments and
+        reconcile them.
+        move_line_maps contains for each voucher the move line created for
+        each voucher line.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Invoice = pool.get('account.invoice')
+
+        if converter is None:
+            converter = CurrencyConverter()
+        with timing('create_moves.get_reconciliations', vouchers):
+            payment_lines = defaultdict(list)
+            reconciled = set()
+            to_reconcile = []
+            for voucher, move_line_map in zip(vouchers, move_line_maps):
+                invoice_payments, reconciliations = (
+                    voucher.get_reconciliations(move_line_map,
+                        reconciled=reconciled, payment_lines=payment_lines,
+                        converter=converter))
+                for invoice, lines in invoice_payments.items():
+                    payment_lines[invoice].extend(lines)
+                for lines in reconciliations:
+                    reconciled.update(lines)
+                    to_reconcile.append(lines)
+
+        with timing('create_moves.reconcile', vouchers):
+            to_write = []
+            for invoice, lines in payment_lines.items():
+                to_write.append([invoice])
+                to_write.append({
+                        'payment_lines': [
+                            ('add', list({l.id for l in lines}))],
+                        })
+            if to_write:
+                Invoice.write(*to_write)
+            if to_reconcile:
+                MoveLine.reconcile(*to_reconcile)
+
+    @classmethod
+    def preview_post(cls, vouchers):
+        '''
+        Return the moves that posting the vouchers would create without
+        modifying anything. For each voucher, the result contains:
+            - id: the voucher id
+            - move_lines: the values of the proposed move lines identified by
+              negative ids
+            - writeoff: the values of the write-off line or None
+            - remainder: the values of the line with the remaining amount or
+              None
+            - reconciliations: the list of line ids to reconcile together
+            - invoice_payments: the invoice ids with the line ids to add as
+              payment
+            - warnings: the messages of the warnings that post would ask to
+              confirm
+        or the id and the error message if the voucher can not be posted.
+        The vouchers are checked like post without using nor deleting the
+        confirmed warnings. Only draft vouchers are previewed.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        vouchers = [v for v in cls.browse(vouchers) if v.state == 'draft']
+        converter = CurrencyConverter()
+        payment_lines = defaultdict(list)
+        reconciled = set()
+        new_ids = {}
+        result = []
+
+        def get_ids(lines):
+            return sorted(new_ids.get(l, l.id) for l in lines)
+
+        for voucher in vouchers:
+            try:
+                cls.check_already_reconciled([voucher])
+                voucher_warnings = [message for _, message
+                    in voucher._check_amount_invoices()]
+                voucher.move = voucher.get_move()
+                with Transaction().set_context(
+                        _voucher_converter=converter):
+                    move_lines, move_line_map, writeoff, remainder = (
+                        voucher.get_move_lines())
+            except UserError as exception:
+                result.append({
+                        'id': voucher.id,
+                        'error': exception.message,
+                        })
+                continue
+            lines = []
+            for values in move_lines:
+                line = MoveLine(**values)
+                new_ids[line] = values['id'] = -(len(new_ids) + 1)
+                lines.append(line)
+
+            invoice_payments, reconciliations = voucher.get_reconciliations(
+                {l: lines[i] for l, i in move_line_map.items()},
+                reconciled=reconciled, payment_lines=payment_lines,
+                converter=converter)
+            for invoice, invoice_lines in invoice_payments.items():
+                payment_lines[invoice].extend(invoice_lines)
+            for reconciliation in reconciliations:
+                reconciled.update(reconciliation)
+            result.append({
+                    'id': voucher.id,
+                    'move_lines': move_lines,
+                    'writeoff': writeoff,
+                    'remainder': remainder,
+                    'reconciliations': [
+                        get_ids(l) for l in reconciliations],
+                    'invoice_payments': [
+                        (i.id, get_ids(l))
+                        for i, l in invoice_payments.items()],
+                    'warnings': voucher_warnings,
+                    })
+        return result
+
+    def get_reconciliations(self, move_lines, reconciled=None,
+            payment_lines=None, converter=None):
+        '''
+        Return the lines to add as payment of each invoice and the list of
+        lines to reconcile together.
+        move_lines is a dictionary with the move line of each voucher line.
+        reconciled is the set of lines already planned to be reconciled and
+        payment_lines the lines already planned to be added to each invoice.
+        converter is the CurrencyConverter used to compute the amounts.
+        '''
+        if converter is None:
+            converter = CurrencyConverter()
+        if reconciled is None:
+            reconciled = set()
+        if payment_lines is None:
+            payment_lines = {}
         lines_to_reconcile = defaultdict(list)
-        payment_lines_to_relate = defaultdict(list)
+        invoice_payments = defaultdict(list)
 
+        origins = self._get_lines_origin_models()
         for line in self.lines:
-            origin = str(line.move_line.move_origin)
-            origin = origin[:origin.find(',')]
-            if origin not in ['account.invoice',
-                    'account.voucher']:
+            if line not in move_lines:
                 continue
-            if line.amount == _ZERO:
+            if origins.get(line) != 'account.invoice':
                 continue
+            invoice = line.move_line.move_origin
 
             amount_second_currency = (line.amount if
                 self.currency != self.company.currency else None)
-            invoice = Invoice(line.move_line.move_origin.id)
-            with Transaction().set_context(
-                    currency_rate=self.currency_rate, date=self.date):
-                amount = Currency.compute(self.currency,
-                    line.amount, self.company.currency)
+            amount = converter.compute(self.currency,
+                line.amount, self.company.currency, date=self.date,
+                currency_rate=self.currency_rate)
 
             reconcile_lines, remainder = \
                 self.get_reconcile_lines_for_amount(invoice, amount,
                     amount_second_currency,
-                    lines_to_reconcile[line.account.id])
+                    reconciled.union(lines_to_reconcile[line.account.id]),
+                    payment_lines=payment_lines.get(invoice))
 
             if remainder == _ZERO:
-                for reconcile_line in reconcile_lines:
-                    lines_to_reconcile[line.account.id].append(
-                        reconcile_line.id)
+                lines_to_reconcile[line.account.id].extend(reconcile_lines)
 
-            for move_line in created_lines:
-                if move_line.party is None:
-                    continue
-                if move_line.description == 'advance':
-                    continue
-                if (move_line.debit != abs(amount) and
-                        move_line.credit != abs(amount) and
-                        (move_line.amount_second_currency and
-                        abs(move_line.amount_second_currency) !=
-                        abs(line.amount))):
-                    continue
-                invoice_number = invoice.reference
-                if invoice.type == 'out':
-                    invoice_number = invoice.number
-                if move_line.description == invoice_number:
-                    if remainder == _ZERO:
-                        lines_to_reconcile[move_line.account.id].append(
-                            move_line.id)
-                    payment_lines_to_relate[invoice].append(move_line.id)
-
-        if payment_lines_to_relate:
-            for invoice, payment_lines in payment_lines_to_relate.items():
-                Invoice.write([invoice], {
-                    'payment_lines': [('add', list(set(payment_lines)))],
-                    })
+            move_line = move_lines[line]
+            if move_line.party is None:
+                continue
+            if remainder == _ZERO:
+                lines_to_reconcile[move_line.account.id].append(move_line)
+            invoice_payments[invoice].append(move_line)
 
-        if lines_to_reconcile:
-            for lines_ids in lines_to_reconcile.values():
-                if not lines_ids:
-                    continue
-                lines = MoveLine.browse(list(set(lines_ids)))
-                remainder = sum((l.debit - l.credit)
-                    for l in lines)
-                if remainder == _ZERO:
-                    MoveLine.reconcile(lines)
+        reconciliations = []
+        for lines in lines_to_reconcile.values():
+            lines = list(set(lines))
+            if not lines:
+                continue
+            remainder = sum((l.debit - l.credit) for l in lines)
+            if remainder == _ZERO:
+                reconciliations.append(lines)
 
-        reconcile_lines = []
-        if self.lines_credits:
-            for line in self.lines_credits:
-                reconcile_lines.append(line.move_line)
-            for move_line in created_lines:
-                if move_line.description == 'advance':
-                    reconcile_lines.append(move_line)
-        if reconcile_lines:
-            MoveLine.reconcile(reconcile_lines)
-
-        reconcile_lines = []
-        if self.lines_debits:
-            for line in self.lines_debits:
-                reconcile_lines.append(line.move_line)
-            for move_line in created_lines:
-                if move_line.description == 'advance':
-                    reconcile_lines.append(move_line)
-        if reconcile_lines:
-            MoveLine.reconcile(reconcile_lines)
+        for advance_lines in (self.lines_credits, self.lines_debits):
+            lines = []
+            for line in advance_lines:
+                lines.append(line.move_line)
+                if line in move_lines:
+                    lines.append(move_lines[line])
+            if lines:
+                reconciliations.append(lines)
 
-        return True
+        return invoice_payments, reconciliations
 
     def get_reconcile_lines_for_amount(self, invoice, amount,
-            amount_second_currency, reconcile_lines):
+            amount_second_currency, reconcile_lines, payment_lines=None):
         '''
         Return list of lines and the remainder to make reconciliation.
+        reconcile_lines are the lines or the ids of lines to exclude and
+        payment_lines the lines to add to the payment lines of the invoice.
         '''
         if self.voucher_type == 'payment':
             amount = -amount
             if amount_second_currency:
                 amount_second_currency = -amount_second_currency
         party = invoice.party
-        Result = namedtuple('Result', ['lines', 'remainder'])
+        excluded = {int(l) for l in reconcile_lines}
 
         lines = [
-            l for l in invoice.payment_lines + invoice.lines_to_pay
+            l for l in (list(invoice.payment_lines)
+                + list(payment_lines or []) + list(invoice.lines_to_pay))
             if not l.reconciliation
             and (not invoice.account.party_required or l.party == party)
-            and (l.id not in reconcile_lines)]
-
-        best = Result([], invoice.total_amount)
-        for n in range(len(lines), 0, -1):
-            for comb_lines in combinations(lines, n):
-                remainder = sum((l.debit - l.credit)
-                    for l in comb_lines)
-                remainder -= amount
-                result = Result(list(comb_lines), remainder)
-                if invoice.currency.is_zero(remainder):
-                    return result
-                if abs(remainder) < abs(best.remainder):
-                    best = result
+            and (l.id not in excluded)]
+
+        default = ReconcileResult([], invoice.total_amount)
+        if not lines:
+            return default
+        result = self.match_lines_for_amount(lines,
+            [l.debit - l.credit for l in lines], amount, invoice.currency)
+        if invoice.currency.is_zero(result.remainder):
+            return result
         if amount_second_currency:
-            best = Result([], invoice.total_amount)
-            for n in range(len(lines), 0, -1):
-                for comb_lines in combinations(lines, n):
-                    remainder = sum((l.amount_second_currency)
-                        for l in comb_lines)
-                    remainder -= amount_second_currency
-                    result = Result(list(comb_lines), remainder)
-                    if invoice.currency.is_zero(remainder):
-                        return result
-                    if abs(remainder) < abs(best.remainder):
-                        best = result
-        return best
+            result = self.match_lines_for_amount(lines,
+                [l.amount_second_currency or _ZERO for l in lines],
+                amount_second_currency, invoice.currency)
+            if invoice.currency.is_zero(result.remainder):
+                return result
+        if abs(result.remainder) < abs(default.remainder):
+            return result
+        return default
+
+    @classmethod
+    def match_lines_for_amount(cls, lines, amounts, amount, currency):
+        '''
+        Return the lines which amounts sum is the closest to amount and the
+        remainder.
+        Only the first reconcile_max_lines lines are combined exhaustively,
+        the next lines are only used by the greedy solution.
+        '''
+        if not lines:
+            return ReconcileResult([], -amount)
+        max_lines = config.getint(
+            'account_voucher_ar', 'reconcile_max_lines', default=30)
+        timeout = config.getfloat(
+            'account_voucher_ar', 'reconcile_timeout', default=2)
+        factor = Decimal(10) ** currency.digits
+        indexes, remainder = match_amount(
+            [int(currency.round(a) * factor) for a in amounts],
+            int(currency.round(amount) * factor),
+            max_lines=max_lines, timeout=timeout)
+        return ReconcileResult(
+            [lines[i] for i in indexes], Decimal(remainder) / factor)
 
     def create_cancel_move(self):
+        "Create, post and reconcile the move which cancels the voucher move"
+        warnings.warn(
+            "create_cancel_move is deprecated, use create_cancel_moves",
+            DeprecationWarning, stacklevel=2)
+        self.create_cancel_moves([self])
+        return True
+
+    @classmethod
+    def create_cancel_moves(cls, vouchers):
         pool = Pool()
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
-        Period = pool.get('account.period')
         Reconciliation = pool.get('account.move.reconciliation')
         Invoice = pool.get('account.invoice')
         PaymentLine = pool.get('account.invoice-account.move.line')
 
-        reconciliations = [x.reconciliation for x in self.move.lines
-                if x.reconciliation]
-        with Transaction().set_user(0, set_context=True):
-            if reconciliations:
-                Reconciliation.delete(reconciliations)
-
-        # Remove payment lines from their invoices.
-        payments = defaultdict(list)
-        ids = list(map(int, self.move.lines))
-        for sub_ids in grouped_slice(ids):
-            payment_lines = PaymentLine.search([
-                ('line', 'in', list(sub_ids)),
-                ])
-            for payment_line in payment_lines:
-                payments[payment_line.invoice].append(payment_line.line)
-        to_write = []
-        for invoice, lines in payments.items():
-            to_write.append([invoice])
-            to_write.append({'payment_lines': [('remove', lines)]})
-        if to_write:
-            Invoice.write(*to_write)
+        with timing('create_cancel_moves.unreconcile', vouchers):
+            move_lines = [l for v in vouchers for l in v.move.lines]
+            reconciliations = list({x.reconciliation for x in move_lines
+                    if x.reconciliation})
+            with Transaction().set_user(0, set_context=True):
+                if reconciliations:
+                    Reconciliation.delete(reconciliations)
+
+            # Remove payment lines from their invoices.
+            payments = defaultdict(list)
+            ids = list(map(int, move_lines))
+            for sub_ids in grouped_slice(ids):
+                payment_lines = PaymentLine.search([
+                    ('line', 'in', list(sub_ids)),
+                    ])
+                for payment_line in payment_lines:
+                    payments[payment_line.invoice].append(payment_line.line)
+            to_write = []
+            for invoice, lines in payments.items():
+                to_write.append([invoice])
+                to_write.append({'payment_lines': [('remove', lines)]})
+            if to_write:
+                Invoice.write(*to_write)
+
+        with timing('create_cancel_moves.moves', vouchers):
+            cancel_moves = cls.get_cancel_moves(vouchers)
+            to_write = []
+            for voucher, cancel_move in zip(vouchers, cancel_moves):
+                to_write.extend(
+                    ([voucher], {'move_cancelled': cancel_move.id}))
+            if to_write:
+                cls.write(*to_write)
+
+            Move.post(cancel_moves)
+
+        with timing('create_cancel_moves.reconcile', vouchers):
+            to_reconcile = []
+            for voucher, cancel_move in zip(vouchers, cancel_moves):
+                lines_to_reconcile = defaultdict(list)
+                for line in (list(voucher.move.lines)
+                        + list(cancel_move.lines)):
+                    if line.account.reconcile:
+                        lines_to_reconcile[line.account.id].append(line)
+                to_reconcile.extend(lines_to_reconcile.values())
+            if to_reconcile:
+                MoveLine.reconcile(*to_reconcile)
+
+    def get_cancel_move(self):
+        "Return the copy of the voucher move which reverses it"
+        cancel_move, = self.get_cancel_moves([self])
+        return cancel_move
 
-        cancelled_move, = Move.copy([self.move], {
-            'period': Period.find(self.company, date=self.move.date),
-            'date': self.move.date,
-            })
-        self.write([self], {
-            'move_cancelled': cancelled_move.id,
-            })
-
-        for line in cancelled_move.lines:
-            aux = line.debit
-            line.debit = line.credit
-            line.credit = aux
-            line.amount_second_currency = (line.amount_second_currency * -1 if
-                line.amount_second_currency else _ZERO)
-            line.save()
+    @classmethod
+    def get_cancel_moves(cls, vouchers):
+        '''
+        Return the copies of the voucher moves which reverse them at the date
+        of the moves.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
 
-        Move.post([self.move_cancelled])
+        origins = {v.move.id: str(v) for v in vouchers}
 
-        lines_to_reconcile = defaultdict(list)
-        for line in self.move.lines:
-            if line.account.reconcile:
-                lines_to_reconcile[line.account.id].append(line)
-        for cancel_line in cancelled_move.lines:
-            if cancel_line.account.reconcile:
-                lines_to_reconcile[cancel_line.account.id].append(cancel_line)
+        def period(data):
+            return Period.find(data['company'], date=data['date']).id
 
-        for lines in list(lines_to_reconcile.values()):
-            MoveLine.reconcile(lines)
+        def amount_second_currency(data):
+            if data['amount_second_currency']:
+                return data['amount_second_currency'] * -1
+            return data['amount_second_currency']
 
-        return True
+        return Move.copy([v.move for v in vouchers], default={
+                'origin': lambda data: origins[data['id']],
+                'period': period,
+                'lines.debit': lambda data: data['credit'],
+                'lines.credit': lambda data: data['debit'],
+                'lines.amount_second_currency': amount_second_currency,
+                })
 
     @classmethod
     def check_already_reconciled(cls, vouchers):
@@ -907,38 +1783,163 @@ class AccountVoucher(Workflow, ModelSQL, ModelView):
     def check_amount_invoices(cls, vouchers):
         Warning = Pool().get('res.user.warning')
         for voucher in vouchers:
-            if voucher.amount_invoices > voucher.amount:
-                raise UserError(gettext(
-                    'account_voucher_ar.msg_amount_invoices_greater_amount'))
-            if (voucher.amount_invoices and
-                    voucher.amount > voucher.amount_invoices):
-                key = 'account_voucher_amount_greater@%s' % str(voucher.id)
+            for key, message in voucher._check_amount_invoices():
                 if Warning.check(key):
-                    raise UserWarning(key, gettext(
-                        'account_voucher_ar.msg_amount_greater_amount_invoices'))
+                    raise UserWarning(key, message)
+
+    def _check_amount_invoices(self):
+        '''
+        Raise an error if the amount of the invoices is greater than the amount
+        and return the key and the message of the warnings to confirm.
+        '''
+        if self.amount_invoices > self.amount:
+            raise UserError(gettext(
+                'account_voucher_ar.msg_amount_invoices_greater_amount'))
+        warnings = []
+        if self.amount_invoices and self.amount > self.amount_invoices:
+            warnings.append((
+                    'account_voucher_amount_greater@%s' % str(self.id),
+                    gettext('account_voucher_ar'
+                        '.msg_amount_greater_amount_invoices')))
+        return warnings
 
     @classmethod
     @ModelView.button
     @Workflow.transition('posted')
     def post(cls, vouchers):
-        cls.check_already_reconciled(vouchers)
-        cls.check_amount_invoices(vouchers)
-        for voucher in vouchers:
-            voucher.set_number()
-            move_lines = voucher.prepare_move_lines()
-            voucher.create_move(move_lines)
+        with timing('post.check_already_reconciled', vouchers):
+            cls.check_already_reconciled(vouchers)
+        with timing('post.check_amount_invoices', vouchers):
+            cls.check_amount_invoices(vouchers)
+        with timing('post.set_number', vouchers):
+            cls.set_numbers(vouchers)
+        with timing('post.create_moves', vouchers):
+            cls.create_moves(vouchers)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('cancelled')
     def cancel(cls, vouchers):
-        for voucher in vouchers:
-            voucher.create_cancel_move()
+        with timing('cancel.create_cancel_moves', vouchers):
+            cls.create_cancel_moves(vouchers)
+
+    @classmethod
+    def get_timing_stats(cls):
+        '''
+        Return the aggregated calls, records, duration and queries of each
+        phase of post and cancel recorded by this process
+        '''
+        return timing_stats()
+
+    @classmethod
+    def clear_timing_stats(cls):
+        reset_timing_stats()
+
+    @classmethod
+    def mass_post(cls, ids, chunk_size=None, processes=None):
+        '''
+        Post the vouchers by chunks of chunk_size, each chunk in its own
+        transaction and optionally with a pool of processes.
+        Return a dictionary with:
+            - posted: the list of posted ids
+            - errors: the error message of each voucher not posted
+            - duration: the number of seconds taken
+            - rate: the number of vouchers posted per second
+        '''
+        transaction = Transaction()
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'account_voucher_ar', 'post_chunk_size', default=100)
+        if processes is None:
+            processes = config.getint(
+                'account_voucher_ar', 'post_processes', default=0)
+        database_name = transaction.database.name
+        context = dict(transaction.context)
+        arguments = [
+            (database_name, transaction.user, list(sub_ids), context)
+            for sub_ids in grouped_slice(ids, chunk_size)]
+
+        started = time.monotonic()
+        if processes and len(arguments) > 1:
+            with process_pool(processes) as mpool:
+                results = mpool.starmap(post_vouchers, arguments)
+        else:
+            results = (post_vouchers(*a) for a in arguments)
+        posted, errors = [], {}
+        for chunk_posted, chunk_errors in results:
+            posted.extend(chunk_posted)
+            errors.update(chunk_errors)
+        duration = time.monotonic() - started
+
+        rate = len(posted) / duration if duration else 0
+        logger.info(
+            "posted %i vouchers in %.2f s (%.1f vouchers/s), %i failed",
+            len(posted), duration, rate, len(errors))
+        return {
+            'posted': posted,
+            'errors': errors,
+            'duration': duration,
+            'rate': rate,
+            }
+
+    @classmethod
+    def mass_post_draft(cls):
+        "Post the draft vouchers until today, intended to be run by cron"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        vouchers = cls.search([
+                ('state', '=', 'draft'),
+                ('date', '<=', Date.today()),
+                ], order=[('date', 'ASC'), ('id', 'ASC')])
+        return cls.mass_post([v.id for v in vouchers])
+
+
+class VoucherAmountsMixin(object):
+    "Update the stored amounts of the voucher when lines are modified"
+    __slots__ = ()
+    _voucher_amount_fields = set()
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        records = super().create(vlist)
+        Voucher.update_amounts({r.voucher for r in records if r.voucher})
+        return records
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        vouchers = set()
+        all_records = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if values.keys() & (cls._voucher_amount_fields | {'voucher'}):
+                vouchers.update(r.voucher for r in records if r.voucher)
+                all_records.extend(records)
+        super().write(*args)
+        vouchers.update(r.voucher for r in all_records if r.voucher)
+        if vouchers:
+            Voucher.update_amounts(vouchers)
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
 
-class AccountVoucherLine(ModelSQL, ModelView):
+        vouchers = {r.voucher for r in records if r.voucher}
+        super().delete(records)
+        if vouchers:
+            Voucher.update_amounts(vouchers)
+
+
+class AccountVoucherLine(VoucherAmountsMixin, ModelSQL, ModelView):
     'Account Voucher Line'
     __name__ = 'account.voucher.line'
+    _voucher_amount_fields = {'amount', 'amount_unreconciled'}
 
     _states = {'readonly': True}
     _states_done = {'readonly': Eval('context', {}).get(
@@ -947,7 +1948,7 @@ class AccountVoucherLine(ModelSQL, ModelView):
     voucher = fields.Many2One('account.voucher', 'Voucher',
         required=True, ondelete='CASCADE')
     reference = fields.Function(fields.Char('reference'),
-        'get_reference')
+        'get_reference', searcher='search_reference')
     name = fields.Char('Name', states=_states)
     account = fields.Many2One('account.account', 'Account',
         domain=[
@@ -977,27 +1978,75 @@ class AccountVoucherLine(ModelSQL, ModelView):
     def __setup__(cls):
         super().__setup__()
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.line_type, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(t, (t.voucher, Index.Equality())),
+                Index(t, (t.move_line, Index.Equality())),
+                })
 
-    def get_reference(self, name):
-        Invoice = Pool().get('account.invoice')
+    @classmethod
+    def _reference_query(cls):
+        "Return a SQL query with the id and the invoice reference of lines"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        Rule = pool.get('ir.rule')
+        table = cls.__table__()
+        move_line = MoveLine.__table__()
+        invoice = Invoice.__table__()
+
+        invoice_query = Rule.query_get(Invoice.__name__)
+        return table.join(move_line, 'LEFT',
+            condition=table.move_line == move_line.id
+            ).join(invoice, 'LEFT',
+                condition=(invoice.move == move_line.move)
+                & invoice.id.in_(invoice_query)
+            ).select(
+                table.id.as_('id'),
+                invoice.reference.as_('reference'))
+
+    @classmethod
+    def get_reference(cls, lines, name):
+        cursor = Transaction().connection.cursor()
 
-        if self.move_line.move:
-            invoices = Invoice.search([
-                ('move', '=', self.move_line.move.id)])
-            if invoices:
-                return invoices[0].reference
+        references = dict.fromkeys(map(int, lines))
+        query = cls._reference_query()
+        for sub_ids in grouped_slice(list(references.keys())):
+            cursor.execute(*query.select(query.id, query.reference,
+                    where=reduce_ids(query.id, sub_ids)))
+            references.update(cursor)
+        return references
+
+    @classmethod
+    def search_reference(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = cls._reference_query()
+        column = query.reference
+        if value is None and operator in {'=', '!='}:
+            if operator == '=':
+                where = column == Null
+            else:
+                where = column != Null
+        elif operator in {'in', 'not in'}:
+            where = Operator(column, [v for v in value if v is not None])
+            if any(v is None for v in value):
+                if operator == 'in':
+                    where |= column == Null
+                else:
+                    where &= column != Null
+        else:
+            where = Operator(column, value)
+        return [('id', 'in', query.select(query.id, where=where))]
 
     def get_expire_date(self, name):
         if self.move_line:
             return self.move_line.maturity_date
 
 
-class AccountVoucherLineCredits(ModelSQL, ModelView):
+class AccountVoucherLineCredits(VoucherAmountsMixin, ModelSQL, ModelView):
     'Account Voucher Line Credits'
     __name__ = 'account.voucher.line.credits'
+    _voucher_amount_fields = {'amount_original'}
 
     _states = {'readonly': True}
     _states_done = {'readonly': Eval('context', {}).get(
@@ -1034,14 +2083,16 @@ class AccountVoucherLineCredits(ModelSQL, ModelView):
     def __setup__(cls):
         super().__setup__()
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.line_type, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(t, (t.voucher, Index.Equality())),
+                Index(t, (t.move_line, Index.Equality())),
+                })
 
 
-class AccountVoucherLineDebits(ModelSQL, ModelView):
+class AccountVoucherLineDebits(VoucherAmountsMixin, ModelSQL, ModelView):
     'Account Voucher Line Debits'
     __name__ = 'account.voucher.line.debits'
+    _voucher_amount_fields = {'amount_original'}
 
     _states = {'readonly': True}
     _states_done = {'readonly': Eval('context', {}).get(
@@ -1078,14 +2129,16 @@ class AccountVoucherLineDebits(ModelSQL, ModelView):
     def __setup__(cls):
         super().__setup__()
         t = cls.__table__()
-        #cls._sql_indexes.update({
-            #Index(t, (t.line_type, Index.Equality())),
-            #})
+        cls._sql_indexes.update({
+                Index(t, (t.voucher, Index.Equality())),
+                Index(t, (t.move_line, Index.Equality())),
+                })
 
 
-class AccountVoucherLinePaymode(ModelSQL, ModelView):
+class AccountVoucherLinePaymode(VoucherAmountsMixin, ModelSQL, ModelView):
     'Account Voucher Line Pay Mode'
     __name__ = 'account.voucher.line.paymode'
+    _voucher_amount_fields = {'pay_amount'}
 
     _states_done = {'readonly': Eval('context', {}).get(
         'voucher_state', 'draft').in_(['posted', 'cancelled'])}
@@ -1101,6 +2154,8 @@ class AccountVoucherLinePaymode(ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super(AccountVoucherLinePaymode, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.voucher, Index.Equality())))
         cls._buttons.update({
             'calculate_remaining_amount': {
                 'invisible': ~Eval('_parent_voucher.state').in_(
@@ -1118,18 +2173,275 @@ class AccountVoucherLinePaymode(ModelSQL, ModelView):
         self.pay_amount = self.voucher.amount_invoices - self.voucher.amount
 
 
+class PostVouchersStart(ModelView):
+    'Post Vouchers'
+    __name__ = 'account.voucher.post_batch.start'
+
+    chunk_size = fields.Integer('Chunk Size', required=True,
+        domain=[('chunk_size', '>', 0)],
+        help="The number of vouchers posted in each transaction.")
+    processes = fields.Integer('Processes', required=True,
+        domain=[('processes', '>=', 0)],
+        help="The number of processes used to post the vouchers.\n"
+        "Leave 0 to post them in the same process.")
+
+    @classmethod
+    def default_chunk_size(cls):
+        return config.getint(
+            'account_voucher_ar', 'post_chunk_size', default=100)
+
+    @classmethod
+    def default_processes(cls):
+        return config.getint(
+            'account_voucher_ar', 'post_processes', default=0)
+
+
+class PostVouchersResult(ModelView):
+    'Post Vouchers'
+    __name__ = 'account.voucher.post_batch.result'
+
+    posted = fields.Integer('Posted', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    duration = fields.TimeDelta('Duration', readonly=True)
+    rate = fields.Float('Vouchers per Second', digits=(16, 1),
+        readonly=True)
+    errors = fields.Text('Errors', readonly=True)
+
+
+class PostVouchers(Wizard):
+    'Post Vouchers'
+    __name__ = 'account.voucher.post_batch'
+
+    start = StateView('account.voucher.post_batch.start',
+        'account_voucher_ar.post_batch_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Post', 'post', 'tryton-ok', default=True),
+            ])
+    post = StateTransition()
+    result = StateView('account.voucher.post_batch.result',
+        'account_voucher_ar.post_batch_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_post(self):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        report = Voucher.mass_post(
+            [v.id for v in self.records if v.state == 'draft'],
+            chunk_size=self.start.chunk_size,
+            processes=self.start.processes)
+        self.result.posted = len(report['posted'])
+        self.result.failed = len(report['errors'])
+        self.result.duration = dt.timedelta(seconds=report['duration'])
+        self.result.rate = report['rate']
+        self.result.errors = '\n'.join(
+            '%s: %s' % (v.rec_name, report['errors'][v.id])
+            for v in Voucher.browse(sorted(report['errors'])))
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'posted': self.result.posted,
+            'failed': self.result.failed,
+            'duration': self.result.duration,
+            'rate': self.result.rate,
+            'errors': self.result.errors,
+            }
+
+
 class AccountVoucherReport(Report):
     __name__ = 'account.voucher'
+    _selection_labels = {}
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__['execute_batch'] = RPC()
+
+    @classmethod
+    def execute_batch(cls, ids, data, output='pdf', chunk_size=None,
+            processes=None):
+        '''
+        Render the report for the vouchers by chunks of chunk_size, each chunk
+        in its own transaction and optionally with a pool of processes.
+        output is either:
+            - pdf: the documents of the chunks are merged into one PDF
+            - zip: a zip file with a document per voucher
+        Return the same tuple as execute.
+        '''
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Voucher = pool.get('account.voucher')
+        transaction = Transaction()
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'account_voucher_ar', 'report_chunk_size', default=50)
+        if processes is None:
+            processes = config.getint(
+                'account_voucher_ar', 'report_processes', default=0)
+        ids = list(map(int, ids))
+        if data.get('action_id'):
+            action_report = ActionReport(data['action_id'])
+        else:
+            action_report, = ActionReport.search([
+                    ('report_name', '=', cls.__name__),
+                    ], limit=1)
+
+        chunks = [list(sub_ids) for sub_ids in grouped_slice(ids, chunk_size)]
+        if output == 'zip':
+            groups = [[[i] for i in chunk] for chunk in chunks]
+        else:
+            groups = [[chunk] for chunk in chunks]
+
+        started = time.monotonic()
+        if processes and len(chunks) > 1:
+            arguments = [
+                (transaction.database.name, transaction.user, g, data,
+                    dict(transaction.context))
+                for g in groups]
+            with process_pool(processes) as mpool:
+                results = mpool.starmap(render_vouchers, arguments)
+        else:
+            results = (cls.render_groups(g, data) for g in groups)
+        documents = [d for result in results for d in result]
+        logger.info("rendered %i vouchers in %i chunks in %.2f s",
+            len(ids), len(chunks), time.monotonic() - started)
+
+        if output == 'zip':
+            content = BytesIO()
+            with zipfile.ZipFile(content, 'w') as content_zip:
+                for voucher, (oext, document) in zip(
+                        Voucher.browse(ids), documents):
+                    content_zip.writestr('%s.%s' % (
+                            voucher.number or voucher.id, oext), document)
+            return 'zip', content.getvalue(), False, action_report.name
+        if len(documents) == 1:
+            oext, content = documents[0]
+            return oext, content, False, action_report.name
+        if (PdfWriter is None
+                or any(oext != 'pdf' for oext, _ in documents)):
+            raise UserError(gettext('account_voucher_ar.msg_report_merge_pdf'))
+        writer = PdfWriter()
+        for _, document in documents:
+            writer.append(BytesIO(document))
+        content = BytesIO()
+        writer.write(content)
+        return 'pdf', content.getvalue(), False, action_report.name
+
+    @classmethod
+    def render_groups(cls, groups, data):
+        "Return the extension and content of the report for each group of ids"
+        documents = []
+        for ids in groups:
+            oext, content, _, _ = cls.execute(ids, data)
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            documents.append((oext, bytes(content)))
+        return documents
 
     @classmethod
     def get_context(cls, records, header, data):
         report_context = super().get_context(records, header, data)
         report_context['company'] = report_context['user'].company
+        report_context['company_header'] = cls.get_company_header(
+            report_context['company'])
         report_context['compute_currency'] = cls.compute_currency
         report_context['format_vat_number'] = cls.format_vat_number
         report_context['get_iva_condition'] = cls.get_iva_condition
+        report_context['views'] = cls.get_views(records)
         return report_context
 
+    @classmethod
+    def get_views(cls, records):
+        '''
+        Return for each voucher id a read-only view of its lines, with their
+        origin and converted amounts, and of its pay lines loaded with bulk
+        reads for all the records
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        models = {
+            'lines': pool.get('account.voucher.line'),
+            'lines_credits': pool.get('account.voucher.line.credits'),
+            'lines_debits': pool.get('account.voucher.line.debits'),
+            }
+
+        vouchers = {r.id: r for r in records}
+        lines = {}
+        for name, Model in models.items():
+            lines[name] = []
+            for sub_ids in grouped_slice(list(vouchers.keys())):
+                lines[name].extend(Model.search([
+                            ('voucher', 'in', list(sub_ids)),
+                            ], order=[('voucher', 'ASC'), ('id', 'ASC')]))
+        pay_lines = []
+        for sub_ids in grouped_slice(list(vouchers.keys())):
+            pay_lines.extend(PayModeLine.search([
+                        ('voucher', 'in', list(sub_ids)),
+                        ], order=[('voucher', 'ASC'), ('id', 'ASC')]))
+
+        move_lines = {
+            l.move_line.id: l.move_line for l in lines['lines']
+            if l.move_line}
+        invoice_ids = {
+            line_id: origin_id for line_id, (model, origin_id)
+            in MoveLine.get_move_origins(move_lines.keys()).items()
+            if model == Invoice.__name__}
+        invoices = {i.id: i for i in Invoice.browse(
+                list(set(invoice_ids.values())))}
+
+        origins = {}
+        for line_id, invoice_id in invoice_ids.items():
+            invoice = invoices[invoice_id]
+            invoice_type = getattr(invoice, 'invoice_type', None)
+            origins[line_id] = VoucherOriginView(
+                invoice_type=invoice_type.rec_name if invoice_type else None,
+                number=invoice.number,
+                reference=invoice.reference,
+                invoice_date=invoice.invoice_date,
+                total_amount=invoice.total_amount,
+                lang=invoice.party.lang)
+
+        converter = CurrencyConverter()
+        views = {
+            i: VoucherView(lines=[], lines_credits=[], lines_debits=[],
+                pay_lines=[])
+            for i in vouchers}
+        for name, voucher_lines in lines.items():
+            for line in voucher_lines:
+                voucher = vouchers[line.voucher.id]
+                move_line = line.move_line
+                origin = None
+                if move_line:
+                    origin = origins.get(move_line.id)
+                if origin is None:
+                    origin = VoucherOriginView(invoice_type=None,
+                        number=None, reference=None, invoice_date=None,
+                        total_amount=_ZERO, lang=voucher.party.lang)
+                amount_original = line.amount_original or _ZERO
+                getattr(views[voucher.id], name).append(VoucherLineView(
+                        id=line.id,
+                        name=line.name,
+                        amount=line.amount,
+                        amount_original=amount_original,
+                        amount_original_company=converter.compute(
+                            voucher.currency, amount_original,
+                            voucher.company.currency, date=voucher.date,
+                            currency_rate=line.currency_rate),
+                        date=line.date,
+                        date_expire=(
+                            move_line.maturity_date if move_line else None),
+                        origin=origin))
+        for line in pay_lines:
+            views[line.voucher.id].pay_lines.append(VoucherPayLineView(
+                    id=line.id,
+                    pay_mode_name=line.pay_mode.rec_name,
+                    pay_amount=line.pay_amount))
+        return views
+
     @classmethod
     def compute_currency(cls, voucher_currency, amount_original,
             company_currency):
@@ -1142,5 +2454,28 @@ class AccountVoucherReport(Report):
 
     @classmethod
     def get_iva_condition(cls, party):
-        return dict(party._fields['iva_condition'].selection)[
+        return cls._get_selection_labels(party, 'iva_condition')[
             party.iva_condition]
+
+    @classmethod
+    def _get_selection_labels(cls, Model, field_name):
+        "Return the labels of the selection field memoized per process"
+        key = (Transaction().database.name, Model.__name__, field_name)
+        labels = cls._selection_labels.get(key)
+        if labels is None:
+            labels = cls._selection_labels[key] = dict(
+                Model._fields[field_name].selection)
+        return labels
+
+    @classmethod
+    def get_company_header(cls, company):
+        "Return the header data of the company"
+        if not company:
+            return None
+        party = company.party
+        address = party.address_get()
+        return CompanyHeader(
+            name=party.full_name,
+            vat_number=cls.format_vat_number(party.vat_number),
+            address=address.full_address if address else '',
+            iva_condition=cls.get_iva_condition(party))
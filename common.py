@@ -0,0 +1,234 @@
+# This file is part of the account_voucher_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.cache import LRUDict
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+class CurrencyConverter(object):
+    '''
+    Convert amounts between currencies computing each rate only once per
+    currency pair, date and explicit currency rate.
+    lookups counts the rates actually computed.
+    '''
+
+    def __init__(self):
+        self._rates = {}
+        self.lookups = 0
+
+    def rate(self, from_currency, to_currency, date=None, currency_rate=None):
+        "Return the rate to convert from_currency into to_currency"
+        key = (int(from_currency), int(to_currency), date, currency_rate)
+        if key not in self._rates:
+            Currency = Pool().get('currency.currency')
+            self.lookups += 1
+            with Transaction().set_context(
+                    currency_rate=currency_rate, date=date):
+                self._rates[key] = Currency.compute(
+                    from_currency, Decimal(1), to_currency, round=False)
+        return self._rates[key]
+
+    def compute(self, from_currency, amount, to_currency, date=None,
+            currency_rate=None, round=True):
+        "Convert amount from from_currency into to_currency"
+        if from_currency != to_currency:
+            amount *= self.rate(
+                from_currency, to_currency, date=date,
+                currency_rate=currency_rate)
+        if round:
+            amount = to_currency.round(amount)
+        return amount
+
+    def compute_many(self, from_currency, amounts, to_currency, date=None,
+            currency_rate=None, round=True):
+        "Convert the list of amounts from from_currency into to_currency"
+        return [
+            self.compute(from_currency, amount, to_currency, date=date,
+                currency_rate=currency_rate, round=round)
+            for amount in amounts]
+
+
+def clear_records_cache(Model, ids):
+    "Clear the records of Model from the caches after an update in SQL"
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if Model.__name__ in cache:
+            cache_cls = cache[Model.__name__]
+            for id_ in ids:
+                cache_cls.pop(id_, None)
+
+
+def _init_process(options):
+    "Load the configuration options of the parent process"
+    for section, values in options.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for name, value in values.items():
+            config.set(section, name, value)
+
+
+def process_pool(processes):
+    '''
+    Return a pool of processes spawned with the configuration of the current
+    process. The processes are not forked so they open their own connections
+    to the database instead of sharing those of the parent.
+    '''
+    options = {s: dict(config.items(s)) for s in config.sections()}
+    return multiprocessing.get_context('spawn').Pool(
+        processes, initializer=_init_process, initargs=(options,))
+
+
+class _QueryCounter(object):
+    "Wrap a connection to count the queries executed by its cursors"
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.count = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self, self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self._cursor.__exit__(type, value, traceback)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __next__(self):
+        return next(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def count_queries():
+    "Count the SQL queries executed by the transaction in the block"
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = transaction.connection = _QueryCounter(connection)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+_timing_lock = threading.Lock()
+_timing_stats = None
+
+
+def _get_timing_stats():
+    "Return the timing stats per phase, created on first use with the lock"
+    global _timing_stats
+    if _timing_stats is None:
+        _timing_stats = LRUDict(
+            config.getint(
+                'account_voucher_ar', 'timing_phases', default=1024),
+            default_factory=lambda: {
+                'calls': 0,
+                'records': 0,
+                'duration': 0.,
+                'queries': 0,
+                })
+    return _timing_stats
+
+
+def timing_enabled():
+    "Return if the timing of the phases is enabled"
+    return bool(Transaction().context.get('voucher_timing')
+        or config.getboolean('account_voucher_ar', 'timing', default=False))
+
+
+@contextmanager
+def timing(phase, records=()):
+    '''
+    Record the wall time and the number of SQL queries of the phase for the
+    records when timing is enabled.
+    '''
+    if not timing_enabled():
+        yield
+        return
+    transaction = Transaction()
+    connection = transaction.connection
+    if isinstance(connection, _QueryCounter):
+        counter = connection
+    else:
+        counter = transaction.connection = _QueryCounter(connection)
+    queries = counter.count
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        queries = counter.count - queries
+        if counter is not connection:
+            transaction.connection = connection
+        count = len(records)
+        with _timing_lock:
+            stats = _get_timing_stats()[phase]
+            stats['calls'] += 1
+            stats['records'] += count
+            stats['duration'] += duration
+            stats['queries'] += queries
+        logger.info(
+            "%s: %i records in %.3f s (%.3f s per record on average) "
+            "with %i queries",
+            phase, count, duration, duration / count if count else duration,
+            queries)
+
+
+def timing_stats():
+    '''
+    Return the aggregated timing stats per phase with the average duration
+    and queries per record.
+    The phases are measured per batch of records, so the values per record
+    are batch averages and not the time spent on each record.
+    '''
+    stats = {}
+    with _timing_lock:
+        for phase, values in _get_timing_stats().items():
+            stats[phase] = values = dict(values)
+            records = values['records'] or 1
+            values['duration_per_record'] = values['duration'] / records
+            values['queries_per_record'] = values['queries'] / records
+    return stats
+
+
+def reset_timing_stats():
+    with _timing_lock:
+        _get_timing_stats().clear()
@@ -1,10 +1,12 @@
 # This file is part of the account_voucher_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Id
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
@@ -38,19 +40,34 @@ class FiscalYear(metaclass=PoolMeta):
     @classmethod
     def validate(cls, years):
         super().validate(years)
-        for year in years:
-            year.check_voucher_sequences()
+        cls.check_years_voucher_sequences(years)
 
     def check_voucher_sequences(self):
+        self.check_years_voucher_sequences([self])
+
+    @classmethod
+    def check_years_voucher_sequences(cls, years):
+        "Check the voucher sequences of the years are not used by other years"
         for sequence in ('payment_sequence', 'receipt_sequence'):
-            fiscalyears = self.search([
-                (sequence, '=', getattr(self, sequence).id),
-                ('id', '!=', self.id),
-                ])
-            if fiscalyears:
-                raise UserError(gettext(
-                    'account_voucher_ar.msg_different_voucher_sequence',
-                    first=self.rec_name, second=fiscalyears[0].rec_name))
+            sequence_ids = {
+                getattr(y, sequence).id for y in years
+                if getattr(y, sequence)}
+            fiscalyears = defaultdict(list)
+            for sub_ids in grouped_slice(sequence_ids):
+                for fiscalyear in cls.search([
+                            (sequence, 'in', list(sub_ids)),
+                            ], order=[('id', 'ASC')]):
+                    fiscalyears[getattr(fiscalyear, sequence).id].append(
+                        fiscalyear)
+            for year in years:
+                if not getattr(year, sequence):
+                    continue
+                others = [f for f in fiscalyears[getattr(year, sequence).id]
+                    if f != year]
+                if others:
+                    raise UserError(gettext(
+                        'account_voucher_ar.msg_different_voucher_sequence',
+                        first=year.rec_name, second=others[0].rec_name))
 
     @classmethod
     def write(cls, *args):
@@ -3,10 +3,19 @@
 # the full copyright notices and license terms.
 from decimal import Decimal
 
+from sql import Null
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs, Round
+
+from trytond import backend
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
+from .common import CurrencyConverter
+
 
 class Move(metaclass=PoolMeta):
     __name__ = 'account.move'
@@ -15,71 +24,255 @@ class Move(metaclass=PoolMeta):
     def _get_origin(cls):
         return super()._get_origin() + ['account.voucher']
 
+    @classmethod
+    def post(cls, moves):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        super().post(moves)
+        Voucher.clear_open_items_cache()
+
 
 class Line(metaclass=PoolMeta):
     __name__ = 'account.move.line'
 
     amount_residual = fields.Function(fields.Numeric('Amount Residual',
-        digits=(16, 2)), 'get_amount_residual')
+        digits=(16, 2)), 'get_amount_residuals',
+        searcher='search_amount_residual')
     amount_residual_second_currency = fields.Function(fields.Numeric(
         'Amount Residual Second Currency', digits=(16, 2)),
-        'get_amount_residual_second_currency')
+        'get_amount_residuals')
     voucher_payments = fields.One2Many('account.voucher.line', 'move_line',
         'Voucher Payments', readonly=True)
 
     @classmethod
-    def get_amount_residual(cls, lines, name):
+    def _open_lines_query(cls):
+        "Return a SQL query with the id and the amounts of the open lines"
+        pool = Pool()
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        line = cls.__table__()
+        account = Account.__table__()
+        type_ = AccountType.__table__()
+
+        query = line.join(account, condition=line.account == account.id
+            ).join(type_, condition=account.type == type_.id
+            ).select(
+                line.id.as_('id'),
+                Abs(line.credit - line.debit).as_('amount'),
+                Abs(line.amount_second_currency).as_(
+                    'amount_second_currency'),
+                where=(line.reconciliation == Null)
+                & (type_.payable | type_.receivable))
+        return query
+
+    @classmethod
+    def get_move_origins(cls, lines):
+        '''
+        Return a dictionary with the origin model name and id of the move for
+        each line id. Lines without origin or with an origin without valid id
+        are not included.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        cursor = Transaction().connection.cursor()
+        line = cls.__table__()
+        move = Move.__table__()
+
+        origins = {}
+        for sub_ids in grouped_slice(list(map(int, lines))):
+            cursor.execute(*line.join(move,
+                    condition=line.move == move.id
+                    ).select(line.id, move.origin,
+                    where=reduce_ids(line.id, sub_ids)
+                    & (move.origin != Null)))
+            for line_id, origin in cursor:
+                model, _, origin_id = origin.partition(',')
+                try:
+                    origins[line_id] = (model, int(origin_id))
+                except ValueError:
+                    continue
+        return origins
+
+    @classmethod
+    def get_amount_residuals(cls, lines, names):
         pool = Pool()
+        Company = pool.get('company.company')
         Currency = pool.get('currency.currency')
+        Voucher = pool.get('account.voucher')
+        VoucherLine = pool.get('account.voucher.line')
+        cursor = Transaction().connection.cursor()
+        voucher = Voucher.__table__()
+        voucher_line = VoucherLine.__table__()
+        company = Company.__table__()
+
+        ids = list(map(int, lines))
+        result = {n: dict.fromkeys(ids, Decimal(0)) for n in names}
+        residuals = result.get('amount_residual', {})
+        residuals_second_currency = result.get(
+            'amount_residual_second_currency', {})
+        open_ids, second_currency_ids = set(), set()
+        payments = []
+        for sub_ids in grouped_slice(ids):
+            open_lines = cls._open_lines_query()
+            cursor.execute(*open_lines.select(
+                    open_lines.id, open_lines.amount,
+                    open_lines.amount_second_currency,
+                    where=reduce_ids(open_lines.id, sub_ids)))
+            for line_id, amount, amount_second_currency in cursor:
+                open_ids.add(line_id)
+                # SQLite uses float for arithmetic
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                residuals[line_id] = amount
+                if amount_second_currency:
+                    if not isinstance(amount_second_currency, Decimal):
+                        amount_second_currency = Decimal(
+                            str(amount_second_currency))
+                    residuals_second_currency[line_id] = (
+                        amount_second_currency)
+                    second_currency_ids.add(line_id)
 
-        amounts = {}
-        for line in lines:
-            if line.reconciliation or not (
-                    line.account.type.payable or line.account.type.receivable):
-                amounts[line.id] = Decimal(0)
+            cursor.execute(*voucher_line.join(voucher,
+                    condition=voucher_line.voucher == voucher.id
+                    ).join(company,
+                    condition=voucher.company == company.id
+                    ).select(
+                    voucher_line.move_line, voucher.currency,
+                    company.currency, voucher.currency_rate, voucher.date,
+                    Sum(voucher_line.amount),
+                    where=reduce_ids(voucher_line.move_line, sub_ids)
+                    & (voucher.state == 'posted'),
+                    group_by=[
+                        voucher_line.move_line, voucher.currency,
+                        company.currency, voucher.currency_rate,
+                        voucher.date]))
+            payments.extend(cursor)
+
+        currencies = {c.id: c for c in Currency.browse(list(
+                    {p[1] for p in payments} | {p[2] for p in payments}))}
+        converter = CurrencyConverter()
+        for (line_id, currency, company_currency, currency_rate, date,
+                amount) in payments:
+            if line_id not in open_ids or not amount:
                 continue
-            amount = abs(line.credit - line.debit)
-
-            for payment in line.voucher_payments:
-                voucher = payment.voucher
-                if voucher and voucher.state == 'posted':
-                    if voucher.currency != voucher.company.currency:
-                        with Transaction().set_context(
-                                currency_rate=voucher.currency_rate,
-                                date=voucher.date):
-                            amount -= Currency.compute(voucher.currency,
-                                payment.amount, voucher.company.currency)
-                    else:
-                        amount -= payment.amount
-            amounts[line.id] = amount
-        return amounts
+            # SQLite uses float for SUM
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
+            currency = currencies[currency]
+            company_currency = currencies[company_currency]
+            if 'amount_residual' in result:
+                residuals[line_id] -= converter.compute(
+                    currency, amount, company_currency,
+                    date=date, currency_rate=currency_rate)
+            if line_id in second_currency_ids:
+                if currency == company_currency:
+                    amount = currency.round(amount)
+                residuals_second_currency[line_id] -= amount
+        return result
 
     @classmethod
-    def get_amount_residual_second_currency(cls, lines, name):
+    def _voucher_payments_query(cls):
+        '''
+        Return a SQL query with the amount paid by posted vouchers per line
+        converted and rounded once per voucher currency, rate and date like
+        get_amount_residuals, the amount paid in the voucher currencies and the
+        digits of the company currency
+        '''
         pool = Pool()
+        Company = pool.get('company.company')
         Currency = pool.get('currency.currency')
+        Voucher = pool.get('account.voucher')
+        VoucherLine = pool.get('account.voucher.line')
+        voucher = Voucher.__table__()
+        voucher_line = VoucherLine.__table__()
+        company = Company.__table__()
+        currency = Currency.__table__()
+        rate = Currency.currency_rate_sql()
+        company_rate = Currency.currency_rate_sql()
 
-        amounts = {}
-        for line in lines:
-            if not line.amount_second_currency or line.reconciliation or not (
-                    line.account.type.payable or line.account.type.receivable):
-                amounts[line.id] = Decimal(0)
-                continue
-            amount = abs(line.amount_second_currency)
-
-            for payment in line.voucher_payments:
-                voucher = payment.voucher
-                if voucher and voucher.state == 'posted':
-                    if voucher.currency != voucher.company.currency:
-                        amount -= payment.amount
-                    else:
-                        with Transaction().set_context(
-                                currency_rate=voucher.currency_rate,
-                                date=voucher.date):
-                            amount -= Currency.compute(voucher.currency,
-                                payment.amount, voucher.company.currency)
-            amounts[line.id] = amount
-        return amounts
+        def rate_condition(rate, currency):
+            return ((rate.currency == currency)
+                & (rate.start_date <= voucher.date)
+                & ((rate.end_date == Null) | (rate.end_date > voucher.date)))
+
+        factor = Case(
+            (voucher.currency == company.currency, 1),
+            else_=Coalesce(
+                voucher.currency_rate, company_rate.rate / rate.rate))
+        payments = voucher_line.join(voucher,
+            condition=voucher_line.voucher == voucher.id
+            ).join(company, condition=voucher.company == company.id
+            ).join(currency, condition=company.currency == currency.id
+            ).join(rate, 'LEFT',
+            condition=rate_condition(rate, voucher.currency)
+            ).join(company_rate, 'LEFT',
+            condition=rate_condition(company_rate, company.currency)
+            ).select(
+                voucher_line.move_line.as_('move_line'),
+                Round(Sum(voucher_line.amount) * factor,
+                    currency.digits).as_('amount'),
+                Sum(voucher_line.amount).as_('amount_second_currency'),
+                currency.digits.as_('digits'),
+                where=voucher.state == 'posted',
+                group_by=[
+                    voucher_line.move_line, voucher.currency,
+                    company.currency, voucher.currency_rate, voucher.date,
+                    currency.digits, rate.rate, company_rate.rate])
+        return payments.select(
+            payments.move_line.as_('move_line'),
+            Sum(payments.amount).as_('amount'),
+            Sum(payments.amount_second_currency).as_(
+                'amount_second_currency'),
+            Max(payments.digits).as_('digits'),
+            group_by=payments.move_line)
+
+    @classmethod
+    def _amount_residual_query(cls):
+        "Return a SQL query with the id, debit, credit and residuals of lines"
+        line = cls.__table__()
+        open_lines = cls._open_lines_query()
+        payments = cls._voucher_payments_query()
+
+        residual = Coalesce(
+            Round(open_lines.amount - payments.amount, payments.digits),
+            open_lines.amount, 0)
+        residual_second_currency = Case(
+            (open_lines.amount_second_currency != 0,
+                open_lines.amount_second_currency
+                - Coalesce(payments.amount_second_currency, 0)),
+            else_=0)
+        return line.join(open_lines, 'LEFT',
+            condition=open_lines.id == line.id
+            ).join(payments, 'LEFT',
+            condition=payments.move_line == line.id
+            ).select(
+                line.id.as_('id'),
+                line.debit.as_('debit'),
+                line.credit.as_('credit'),
+                residual.as_('amount_residual'),
+                residual_second_currency.as_(
+                    'amount_residual_second_currency'))
+
+    @classmethod
+    def search_amount_residual(cls, name, clause):
+        residual = cls._amount_residual_query()
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # SQLite uses float for arithmetic
+        if value is not None and backend.name == 'sqlite':
+            value = float(value)
+        query = residual.select(residual.id,
+            where=Operator(residual.amount_residual, value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def reconcile(cls, *lines_list, **kwargs):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        reconciliations = super().reconcile(*lines_list, **kwargs)
+        Voucher.clear_open_items_cache()
+        return reconciliations
 
     @classmethod
     def copy(cls, lines, default=None):
@@ -89,3 +282,14 @@ class Line(metaclass=PoolMeta):
             default = default.copy()
         default.setdefault('voucher_payments', [])
         return super().copy(lines, default=default)
+
+
+class Reconciliation(metaclass=PoolMeta):
+    __name__ = 'account.move.reconciliation'
+
+    @classmethod
+    def delete(cls, reconciliations):
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        super().delete(reconciliations)
+        Voucher.clear_open_items_cache()
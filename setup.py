@@ -121,6 +121,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     python_requires='>=3.8',
     install_requires=requires,
     extras_require={
+        'pdf': ['pypdf'],
         'test': tests_require,
         },
     zip_safe=False,
@@ -1,15 +1,24 @@
 # This file is part of the account_voucher_ar module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
+from decimal import Decimal
 from itertools import groupby
 
-from trytond.model import fields, Workflow
+from sql import Null
+from sql.functions import CurrentTimestamp
+
+from trytond.model import fields, ModelView, Workflow, Index
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, If, Bool
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+from .common import clear_records_cache
+
 
 class AccountVoucherPayMode(metaclass=PoolMeta):
     __name__ = 'account.voucher.paymode'
@@ -45,10 +54,164 @@ class AccountVoucherLinePaymode(metaclass=PoolMeta):
     related_statement_line = fields.Many2One('account.statement.line',
         'Statement Line', readonly=True)
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.pay_mode, Index.Equality()),
+                (t.pay_amount, Index.Equality()),
+                (t.related_statement_line, Index.Equality())))
+
 
 class Statement(metaclass=PoolMeta):
     __name__ = 'account.statement'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._buttons.update({
+                'match_paymodes': {
+                    'invisible': Eval('state') != 'draft',
+                    'depends': ['state'],
+                    },
+                })
+        cls.__rpc__.update({
+                'match_paymode_lines': RPC(readonly=False, instantiate=0),
+                })
+
+    @classmethod
+    @ModelView.button
+    def match_paymodes(cls, statements):
+        cls.match_paymode_lines(statements)
+
+    @classmethod
+    def match_paymode_lines(cls, statements):
+        '''
+        Relate the statement lines without origin to the pay mode lines of
+        posted vouchers with the same company, journal, currency, type, amount
+        and party if the line has one.
+        When many pay mode lines match, the one of the voucher with the
+        closest date to the line and then the lowest id is used.
+        Return for each statement a dictionary with:
+            - id: the statement id
+            - matched: the pairs of statement line id and pay mode line id
+              matched
+            - ambiguous: the pairs of statement line id and candidate pay mode
+              line ids of the lines matched among many
+            - unmatched: the ids of the statement lines not matched
+        '''
+        pool = Pool()
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        StatementLine = pool.get('account.statement.line')
+
+        result = []
+        reports = {}
+        to_match = []
+        for statement in statements:
+            reports[statement.id] = {
+                'id': statement.id,
+                'matched': [],
+                'ambiguous': [],
+                'unmatched': [],
+                }
+            result.append(reports[statement.id])
+            if statement.state != 'draft':
+                continue
+            to_match.extend(
+                l for l in statement.lines if not l.related_to and l.amount)
+        if not to_match:
+            return result
+
+        index, party_index = cls._get_paymode_index(
+            {l.statement.company.id for l in to_match},
+            {l.statement.journal.id for l in to_match},
+            {abs(l.amount) for l in to_match})
+
+        used = set()
+        to_write = []
+        for line in to_match:
+            key = (line.statement.company.id,
+                line.statement.journal.id,
+                line.statement.journal.currency.id,
+                'receipt' if line.amount > 0 else 'payment',
+                abs(line.amount))
+            if line.party:
+                candidates = party_index[key + (line.party.id,)]
+            else:
+                candidates = index[key]
+            candidates = [c for c in candidates if c[0] not in used]
+            report = reports[line.statement.id]
+            if not candidates:
+                report['unmatched'].append(line.id)
+                continue
+            candidates.sort(
+                key=lambda c: (abs((c[2] - line.date).days), c[2], c[0]))
+            paymode_line_id, party, _, account = candidates[0]
+            used.add(paymode_line_id)
+            report['matched'].append((line.id, paymode_line_id))
+            if len(candidates) > 1:
+                report['ambiguous'].append(
+                    (line.id, [c[0] for c in candidates]))
+            values = {
+                'related_to': str(PayModeLine(paymode_line_id)),
+                }
+            if not line.party:
+                values['party'] = party
+            if account:
+                values['account'] = account
+            to_write.extend(([line], values))
+        if to_write:
+            StatementLine.write(*to_write)
+        return result
+
+    @classmethod
+    def _get_paymode_index(cls, companies, journals, amounts):
+        '''
+        Return the indexes of the unmatched pay mode lines of posted vouchers
+        of the companies for the statement journals and the amounts.
+        The first index is keyed by company, journal, currency, voucher type
+        and amount and the second one by the same keys and the party.
+        Each entry is a list of tuples with the id, the party, the date of the
+        voucher and the account of the pay mode.
+        '''
+        pool = Pool()
+        PayMode = pool.get('account.voucher.paymode')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        Voucher = pool.get('account.voucher')
+        cursor = Transaction().connection.cursor()
+        line = PayModeLine.__table__()
+        paymode = PayMode.__table__()
+        voucher = Voucher.__table__()
+
+        index = defaultdict(list)
+        party_index = defaultdict(list)
+        query = line.join(paymode, condition=line.pay_mode == paymode.id
+            ).join(voucher, condition=line.voucher == voucher.id)
+        for sub_amounts in grouped_slice(amounts):
+            cursor.execute(*query.select(
+                    line.id, voucher.company, paymode.statement_journal,
+                    voucher.currency, voucher.voucher_type, line.pay_amount,
+                    voucher.party, voucher.date, paymode.account,
+                    where=(line.related_statement_line == Null)
+                    & paymode.statement_reconcile
+                    & voucher.company.in_(list(companies))
+                    & paymode.statement_journal.in_(list(journals))
+                    & (voucher.state == 'posted')
+                    & line.pay_amount.in_(list(sub_amounts))))
+            for (line_id, company, journal, currency, voucher_type, amount,
+                    party, date, account) in cursor:
+                # SQLite may return float for NUMERIC
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                key = (company, journal, currency, voucher_type, amount)
+                candidate = (line_id, party, date, account)
+                index[key].append(candidate)
+                party_index[key + (party,)].append(candidate)
+        return index, party_index
+
     @classmethod
     @Workflow.transition('validated')
     def validate_statement(cls, statements):
@@ -87,6 +250,9 @@ class StatementLine(metaclass=PoolMeta):
     statement_journal = fields.Function(
         fields.Many2One('account.statement.journal', 'Statement Journal'),
         'on_change_with_statement_journal')
+    abs_amount = fields.Function(
+        fields.Numeric('Absolute Amount', digits=(16, 2)),
+        'on_change_with_abs_amount')
 
     @classmethod
     def __setup__(cls):
@@ -118,6 +284,11 @@ class StatementLine(metaclass=PoolMeta):
             return self.statement.journal.id
         return None
 
+    @fields.depends('amount')
+    def on_change_with_abs_amount(self, name=None):
+        if self.amount is not None:
+            return abs(self.amount)
+
     @classmethod
     def _get_relations(cls):
         return super()._get_relations() + ['account.voucher.line.paymode']
@@ -152,10 +323,8 @@ class StatementLine(metaclass=PoolMeta):
         lines = super(StatementLine, cls).create(vlist)
         to_update = {}
         for line in lines:
-            if line.related_to and \
-                    str(line.related_to).split(',')[0] == PayMode.__name__:
-                paymode_id = int(str(line.related_to).split(',')[1])
-                to_update[paymode_id] = line.id
+            if isinstance(line.related_to, PayMode):
+                to_update[line.related_to.id] = line.id
         if to_update:
             cls.update_paymode_lines(to_update)
         return lines
@@ -166,26 +335,58 @@ class StatementLine(metaclass=PoolMeta):
         PayMode = pool.get('account.voucher.line.paymode')
 
         actions = iter(args)
-        to_update = {}
+        released, related = set(), {}
         for lines, values in zip(actions, actions):
-            if 'related_to' in values:
-                if values['related_to'] is None:
-                    if isinstance(lines[0].related_to, PayMode):
-                        to_update[lines[0].related_to.id] = None
-                elif values['related_to'].split(',')[0] == PayMode.__name__:
-                    paymode_id = int(values['related_to'].split(',')[1])
-                    to_update[paymode_id] = lines[0].id
+            if 'related_to' not in values:
+                continue
+            for line in lines:
+                if isinstance(line.related_to, PayMode):
+                    released.add(line.related_to.id)
+            paymode_id = cls._get_paymode_id(values['related_to'])
+            if paymode_id is not None:
+                for line in lines:
+                    related[paymode_id] = line.id
+        # Release first so other lines can be related in the same call
+        if released:
+            cls.update_paymode_lines(dict.fromkeys(released))
         super(StatementLine, cls).write(*args)
-        if to_update:
-            cls.update_paymode_lines(to_update)
+        if related:
+            cls.update_paymode_lines(related)
+
+    @classmethod
+    def _get_paymode_id(cls, related_to):
+        "Return the pay mode line id of the related_to value if any"
+        pool = Pool()
+        PayMode = pool.get('account.voucher.line.paymode')
+        if not related_to:
+            return None
+        if isinstance(related_to, str):
+            related_to = related_to.split(',')
+        model, id_ = related_to
+        if model == PayMode.__name__:
+            return int(id_)
 
-    def update_paymode_lines(to_update):
+    @classmethod
+    def update_paymode_lines(cls, to_update):
+        '''
+        Set the statement line of the pay mode lines from the dictionary
+        with one UPDATE per statement line
+        '''
         pool = Pool()
         PayMode = pool.get('account.voucher.line.paymode')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = PayMode.__table__()
 
-        paymodes = []
-        for key in to_update:
-            paymode = PayMode(key)
-            paymode.related_statement_line = to_update[key]
-            paymodes.append(paymode)
-        PayMode.save(paymodes)
+        groups = defaultdict(list)
+        for paymode_id, line_id in to_update.items():
+            groups[line_id].append(paymode_id)
+        for line_id, paymode_ids in groups.items():
+            for sub_ids in grouped_slice(paymode_ids):
+                cursor.execute(*table.update(
+                        [table.related_statement_line, table.write_uid,
+                            table.write_date],
+                        [line_id if line_id is not None else Null,
+                            transaction.user, CurrentTimestamp()],
+                        where=reduce_ids(table.id, sub_ids)))
+        clear_records_cache(PayMode, to_update)
@@ -1,2 +1,6 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+
+from .test_module import create_ledger, set_voucher_sequences
+
+__all__ = ['create_ledger', 'set_voucher_sequences']
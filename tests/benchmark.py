@@ -0,0 +1,275 @@
+# This file is part of the account_voucher_ar module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmarks for the account_voucher_ar module
+
+The workflow benchmark runs on the test database, to use the in memory SQLite
+backend run it with:
+
+    TRYTOND_DATABASE_URI=sqlite:// DB_NAME=:memory: python benchmark.py
+'''
+
+import argparse
+import datetime as dt
+import json
+import platform
+import random
+import subprocess
+import time
+from decimal import Decimal
+from itertools import combinations
+
+from trytond import __version__, backend
+from trytond.modules.account_voucher_ar.account_voucher_ar import (
+    match_amount)
+from trytond.modules.account_voucher_ar.common import (
+    reset_timing_stats, timing, timing_stats)
+from trytond.modules.account_voucher_ar.tests import create_ledger
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency
+from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder, PYSONEncoder
+from trytond.tests.test_tryton import (
+    CONTEXT, DB_NAME, USER, activate_module)
+from trytond.transaction import Transaction
+
+
+def brute_force(amounts, target, timeout=None):
+    "The combinatorial search previously used to find reconcile lines"
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    best = ([], None)
+    for n in range(len(amounts), 0, -1):
+        for indexes in combinations(range(len(amounts)), n):
+            remainder = sum(amounts[i] for i in indexes) - target
+            if not remainder:
+                return list(indexes), remainder
+            if best[1] is None or abs(remainder) < abs(best[1]):
+                best = (list(indexes), remainder)
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+    return best
+
+
+def _timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_reconcile(sizes, timeout, seed=None):
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        amounts = [rng.randint(100, 1000000) for _ in range(n)]
+        # Partial payment of some installments without exact match
+        target = sum(rng.sample(amounts, max(n // 3, 1))) + 1
+        (_, remainder), engine = _timeit(
+            match_amount, amounts, target, max_lines=30, timeout=timeout)
+        result, brute = _timeit(brute_force, amounts, target, timeout=timeout)
+        results.append({
+                'name': 'reconcile',
+                'lines': n,
+                'engine': engine,
+                'engine_remainder': remainder,
+                'brute_force': brute if result is not None else None,
+                'brute_force_remainder': (
+                    result[1] if result is not None else None),
+                })
+    return results
+
+
+def bench_workflow(parties, invoices, installments, currencies, seed=None):
+    '''
+    Time the voucher workflow on a synthetic ledger and return the timing
+    stats of each phase
+    '''
+    activate_module(['account_voucher_ar', 'account_statement'])
+    reset_timing_stats()
+    errors = {}
+    context = CONTEXT.copy()
+    context['voucher_timing'] = True
+    with Transaction().start(DB_NAME, USER, context=context) as transaction:
+        pool = Pool()
+        Identifier = pool.get('party.identifier')
+        MoveLine = pool.get('account.move.line')
+        PayInvoice = pool.get('account.invoice.pay', type='wizard')
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        VoucherReport = pool.get('account.voucher', type='report')
+        StatementJournal = pool.get('account.statement.journal')
+        Statement = pool.get('account.statement')
+        StatementLine = pool.get('account.statement.line')
+
+        company = create_company(currency=create_currency('ARS'))
+        company.party.iva_condition = 'responsable_inscripto'
+        company.party.save()
+        Identifier(
+            party=company.party, type='ar_vat', code='30710158254').save()
+        with set_company(company):
+            with timing('bench.create_ledger'):
+                ledger = create_ledger(company, parties=parties,
+                    invoices=invoices, installments=installments,
+                    currencies=currencies, seed=seed)
+            today = dt.date.today()
+            lines = [l for i in ledger['invoices'] for l in i.lines_to_pay]
+
+            with timing('bench.get_amount_residuals', lines):
+                MoveLine.get_amount_residuals(lines,
+                    ['amount_residual', 'amount_residual_second_currency'])
+
+            session_id, _, _ = PayInvoice.create()
+            pay_invoice = PayInvoice(session_id)
+            with timing('bench.pay_invoice_default_start', ledger['invoices']):
+                for invoice in ledger['invoices']:
+                    with Transaction().set_context(active_id=invoice.id):
+                        pay_invoice.default_start(None)
+            PayInvoice.delete(session_id)
+
+            vouchers = [Voucher(company=company, party=party,
+                    voucher_type='receipt', journal=ledger['journal'],
+                    currency=company.currency, date=today)
+                for party in ledger['parties']]
+            with timing('bench.add_lines', vouchers):
+                for voucher in vouchers:
+                    voucher.add_lines()
+            for voucher in vouchers:
+                for line in voucher.lines:
+                    line.amount = line.amount_unreconciled
+                voucher.pay_lines = [PayModeLine(pay_mode=ledger['paymode'],
+                        pay_amount=sum(l.amount for l in voucher.lines))]
+            Voucher.save(vouchers)
+
+            with timing('bench.post', vouchers):
+                Voucher.post(vouchers)
+
+            try:
+                with timing('bench.report', vouchers):
+                    VoucherReport.execute([v.id for v in vouchers], {})
+            except Exception as exception:
+                errors['report'] = str(exception)
+
+            statement_journal = StatementJournal(name="Cash",
+                journal=ledger['journal'], account=ledger['cash'],
+                currency=company.currency, company=company,
+                validation='balance')
+            statement_journal.save()
+            paymode = ledger['paymode']
+            paymode.statement_reconcile = True
+            paymode.statement_journal = statement_journal
+            paymode.save()
+            paymode_lines = [l for v in vouchers for l in v.pay_lines]
+            domain = PYSONEncoder().encode(
+                StatementLine.related_to.domain[PayModeLine.__name__])
+            statement_lines = []
+            with timing('bench.statement_matching', paymode_lines):
+                for paymode_line in paymode_lines:
+                    candidates = PayModeLine.search(PYSONDecoder({
+                                'id': -1,
+                                'company': company.id,
+                                'party': paymode_line.voucher.party.id,
+                                'statement_journal': statement_journal.id,
+                                'currency': company.currency.id,
+                                'amount': paymode_line.pay_amount,
+                                'abs_amount': paymode_line.pay_amount,
+                                }).decode(domain), limit=1)
+                    if candidates:
+                        candidate, = candidates
+                        statement_lines.append(StatementLine(
+                                number=str(len(statement_lines) + 1),
+                                date=today, amount=candidate.pay_amount,
+                                party=candidate.voucher.party,
+                                account=ledger['cash'],
+                                related_to=candidate))
+                amount = sum(l.amount for l in statement_lines)
+                Statement(name="Statement", journal=statement_journal,
+                    company=company, date=today,
+                    start_balance=Decimal(0), end_balance=amount,
+                    lines=statement_lines).save()
+
+            with timing('bench.cancel', vouchers):
+                Voucher.cancel(vouchers)
+        transaction.rollback()
+    return {
+        'parties': parties,
+        'invoices': invoices,
+        'installments': installments,
+        'currencies': len(currencies) + 1,
+        'phases': timing_stats(),
+        'errors': errors,
+        }
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report_workflow(result):
+    print('workflow parties=%(parties)i invoices=%(invoices)i '
+        'installments=%(installments)i currencies=%(currencies)i' % result)
+    for phase, stats in sorted(result['phases'].items()):
+        print('    %s records=%i %.4fs queries=%i' % (
+                phase, stats['records'], stats['duration'],
+                stats['queries']))
+    for phase, error in result['errors'].items():
+        print('    %s error=%s' % (phase, error))
+
+
+def report(results):
+    for result in results:
+        brute = result['brute_force']
+        print('%(name)s n=%(lines)2d engine=%(engine).4fs' % result, end=' ')
+        if brute is None:
+            print('brute force=timeout')
+        else:
+            print('brute force=%.4fs' % brute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--min-lines', type=int, default=5)
+    parser.add_argument('--max-lines', type=int, default=30)
+    parser.add_argument('--timeout', type=float, default=10,
+        help="maximum seconds for each search")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parties', type=int, default=0,
+        help="number of parties of the workflow benchmark")
+    parser.add_argument('--invoices', type=int, default=5,
+        help="number of invoices per party")
+    parser.add_argument('--installments', type=int, default=3,
+        help="number of installments of the payment term")
+    parser.add_argument('--currency', dest='currencies', nargs=2,
+        action='append', default=[], metavar=('CODE', 'RATE'),
+        help="add a foreign currency for the invoices")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        help="write the results as JSON")
+    options = parser.parse_args()
+
+    results = {
+        'date': dt.datetime.now().isoformat(),
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'trytond': __version__,
+        'backend': backend.name,
+        'seed': options.seed,
+        }
+    results['reconcile'] = bench_reconcile(
+        range(options.min_lines, options.max_lines + 1),
+        options.timeout, seed=options.seed)
+    report(results['reconcile'])
+    if options.parties:
+        results['workflow'] = bench_workflow(
+            options.parties, options.invoices, options.installments,
+            [(c, Decimal(r)) for c, r in options.currencies],
+            seed=options.seed)
+        report_workflow(results['workflow'])
+    if options.output:
+        json.dump(results, options.output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
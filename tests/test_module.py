@@ -1,8 +1,215 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import random
+import unittest
+import zipfile
+from decimal import Decimal
+from io import BytesIO
+from unittest.mock import patch
+
+from sql import Null
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.account_voucher_ar.account_voucher_ar import (
+    match_amount)
+from trytond.modules.account_voucher_ar.common import (
+    CurrencyConverter, count_queries, timing)
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import add_currency_rate, create_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+
+def set_voucher_sequences(fiscalyear):
+    pool = Pool()
+    Sequence = pool.get('ir.sequence')
+    ModelData = pool.get('ir.model.data')
+
+    for voucher_type in ['payment', 'receipt']:
+        sequence = Sequence(name=fiscalyear.name)
+        sequence.sequence_type = ModelData.get_id(
+            'account_voucher_ar', 'seq_type_account_voucher_%s' % voucher_type)
+        sequence.company = fiscalyear.company
+        sequence.save()
+        setattr(fiscalyear, '%s_sequence' % voucher_type, sequence)
+    return fiscalyear
+
+
+def create_ledger(company, parties=10, invoices=1, installments=1,
+        currencies=None, today=None, seed=None):
+    '''
+    Create a chart, a fiscal year and posted customer invoices for the company
+    which must be set in the context.
+    currencies is a list of (code, rate) of foreign currencies used in turn
+    with the company currency for the invoices.
+    Return a dictionary with the created records.
+    '''
+    pool = Pool()
+    Account = pool.get('account.account')
+    FiscalYear = pool.get('account.fiscalyear')
+    Journal = pool.get('account.journal')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    PaymentTermLine = pool.get('account.invoice.payment_term.line')
+    PaymentTermDelta = pool.get('account.invoice.payment_term.line.delta')
+    PayMode = pool.get('account.voucher.paymode')
+
+    if today is None:
+        today = dt.date.today()
+
+    create_chart(company)
+    fiscalyear = set_voucher_sequences(set_invoice_sequences(
+            get_fiscalyear(company, today=today)))
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('party_required', '=', True),
+            ('company', '=', company.id),
+            ], limit=1)
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ], limit=1)
+    cash, = Account.search([
+            ('name', '=', 'Main Cash'),
+            ('company', '=', company.id),
+            ])
+    revenue_journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    cash_journal, = Journal.search([('type', '=', 'cash')], limit=1)
+    paymode = PayMode(name='Cash', account=cash)
+    paymode.save()
+
+    if not company.currency.rates:
+        add_currency_rate(company.currency, Decimal(1))
+    currencies_ = [company.currency]
+    for code, rate in currencies or []:
+        currency = create_currency(code)
+        add_currency_rate(currency, rate)
+        currencies_.append(currency)
+
+    payment_term = PaymentTerm(name="%s installments" % installments)
+    term_lines = []
+    for i in range(installments):
+        term_line = PaymentTermLine(
+            relativedeltas=[PaymentTermDelta(days=30 * i)])
+        if i < installments - 1:
+            term_line.type = 'percent_on_total'
+            term_line.ratio = round(Decimal(1) / installments, 10)
+            term_line.on_change_ratio()
+        else:
+            term_line.type = 'remainder'
+        term_lines.append(term_line)
+    payment_term.lines = term_lines
+    payment_term.save()
+
+    ledger = {
+        'company': company,
+        'fiscalyear': fiscalyear,
+        'receivable': receivable,
+        'revenue': revenue,
+        'cash': cash,
+        'revenue_journal': revenue_journal,
+        'journal': cash_journal,
+        'paymode': paymode,
+        'payment_term': payment_term,
+        'currencies': currencies_,
+        'parties': [],
+        'invoices': [],
+        }
+    create_invoices(
+        ledger, parties=parties, invoices=invoices, today=today, seed=seed)
+    return ledger
+
+
+def create_invoices(ledger, parties=1, invoices=1, today=None, seed=None):
+    '''
+    Create parties with the number of posted customer invoices each on the
+    ledger returned by create_ledger.
+    Return the parties and the invoices which are also added to the ledger.
+    '''
+    pool = Pool()
+    Party = pool.get('party.party')
+    Address = pool.get('party.address')
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+
+    rng = random.Random(seed)
+    if today is None:
+        today = dt.date.today()
+    company = ledger['company']
+    currencies = ledger['currencies']
+
+    parties_ = []
+    for i in range(len(ledger['parties']), len(ledger['parties']) + parties):
+        parties_.append(Party(name="Party %s" % i,
+                iva_condition='consumidor_final',
+                addresses=[Address(street="Street %s" % i)]))
+    Party.save(parties_)
+
+    invoices_ = []
+    for party in parties_:
+        for i in range(invoices):
+            currency = currencies[len(invoices_) % len(currencies)]
+            invoice_date = max(ledger['fiscalyear'].start_date,
+                today - dt.timedelta(days=rng.randrange(60)))
+            invoices_.append(Invoice(type='out', company=company,
+                    party=party, invoice_address=party.addresses[0],
+                    currency=currency, journal=ledger['revenue_journal'],
+                    account=ledger['receivable'],
+                    payment_term=ledger['payment_term'],
+                    invoice_date=invoice_date,
+                    lines=[InvoiceLine(type='line', company=company,
+                            currency=currency, account=ledger['revenue'],
+                            description="Line", quantity=1,
+                            unit_price=Decimal(
+                                rng.randrange(100, 10000000)) / 100)]))
+    Invoice.save(invoices_)
+    Invoice.post(invoices_)
+
+    ledger['parties'].extend(parties_)
+    ledger['invoices'].extend(invoices_)
+    return parties_, invoices_
+
+
+def create_receipts(ledger, payments, date=None):
+    '''
+    Create a draft receipt paying the amount of the invoice for each invoice
+    and amount of payments with the pay mode of the ledger.
+    Return the receipts.
+    '''
+    pool = Pool()
+    Voucher = pool.get('account.voucher')
+    PayModeLine = pool.get('account.voucher.line.paymode')
+
+    if date is None:
+        date = dt.date.today()
+    vouchers = []
+    for invoice, amount in payments:
+        voucher = Voucher(company=ledger['company'], party=invoice.party,
+            voucher_type='receipt', journal=ledger['journal'],
+            currency=invoice.currency, date=date, pay_invoice=invoice)
+        voucher.add_lines()
+        line, = voucher.lines
+        line.amount = amount
+        voucher.pay_lines = [PayModeLine(
+                pay_mode=ledger['paymode'], pay_amount=amount)]
+        vouchers.append(voucher)
+    Voucher.save(vouchers)
+    return vouchers
 
 
 class VoucherArTestCase(CompanyTestMixin, ModuleTestCase):
@@ -10,5 +217,1246 @@ class VoucherArTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'account_voucher_ar'
     extras = ['account_statement']
 
+    def assertQueryUseIndex(self, query):
+        "Assert that the query plan uses an index"
+        cursor = Transaction().connection.cursor()
+        sql, params = tuple(query)
+        if backend.name == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = '\n'.join(str(r[-1]) for r in cursor)
+            self.assertIn('INDEX', plan)
+        elif backend.name == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(r[0] for r in cursor)
+            self.assertIn('Index', plan)
+        else:
+            self.skipTest("Unsupported backend %s" % backend.name)
+
+    def assertQueryCountBounded(self, create, operation, per_slice=0,
+            bound=0, sizes=(10, 1000)):
+        '''
+        Assert that the queries of operation on the records returned by create
+        for each size do not grow more than per_slice queries for each
+        additional slice of ids plus bound queries
+        '''
+        in_max = Transaction().database.IN_MAX
+        counts = []
+        for size in sizes:
+            records = create(size)
+            with count_queries() as counter:
+                operation(records)
+            counts.append(counter.count)
+        slices = [-(-s // in_max) for s in sizes]
+        self.assertLessEqual(counts[-1],
+            counts[0] + per_slice * (slices[-1] - slices[0]) + bound,
+            msg="%s queries for %s records but %s for %s records" % (
+                counts[0], sizes[0], counts[-1], sizes[-1]))
+
+    def test_match_amount(self):
+        "Test match amount"
+        for amounts, target, result in [
+                ([100, 200, 300], 600, ([0, 1, 2], 0)),
+                ([100, 200, 300], 300, ([0, 1], 0)),
+                ([100, 200, 300], 250, ([0, 1], 50)),
+                ([100, -100, 50], 50, ([0, 1, 2], 0)),
+                ([], 10, ([], -10)),
+                ]:
+            with self.subTest(amounts=amounts, target=target):
+                self.assertEqual(match_amount(amounts, target), result)
+
+    def test_match_amount_max_lines(self):
+        "Test match amount with more lines than max lines"
+        amounts = [5] * 40
+        self.assertEqual(
+            match_amount(amounts, 200, max_lines=10), (list(range(40)), 0))
+        indexes, remainder = match_amount(amounts, 100, max_lines=10)
+        self.assertEqual(remainder, 0)
+        self.assertEqual(len(indexes), 20)
+
+    def test_match_amount_timeout(self):
+        "Test match amount keeps the greedy solution after the timeout"
+        amounts = [2 ** i for i in range(40)]
+        self.assertEqual(
+            match_amount(amounts, 2 ** 39 + 1, max_lines=40, timeout=0),
+            (list(range(39)), -2))
+
+    @with_transaction()
+    def test_voucher_indexes(self):
+        "Test voucher queries use indexes"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        voucher = Voucher.__table__()
+
+        self.assertQueryUseIndex(voucher.select(voucher.id,
+                where=voucher.state == 'draft'))
+        self.assertQueryUseIndex(voucher.select(voucher.id,
+                where=(voucher.party == 1)
+                & (voucher.state == 'posted')
+                & (voucher.date >= dt.date.today())))
+
+    @with_transaction()
+    def test_voucher_line_indexes(self):
+        "Test voucher line queries use indexes"
+        pool = Pool()
+        for name in [
+                'account.voucher.line',
+                'account.voucher.line.credits',
+                'account.voucher.line.debits',
+                ]:
+            Line = pool.get(name)
+            line = Line.__table__()
+            with self.subTest(model=name):
+                self.assertQueryUseIndex(line.select(line.id,
+                        where=line.move_line == 1))
+                self.assertQueryUseIndex(line.select(line.id,
+                        where=line.voucher == 1))
+
+    @with_transaction()
+    def test_voucher_paymode_line_indexes(self):
+        "Test voucher pay mode line queries use indexes"
+        pool = Pool()
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        line = PayModeLine.__table__()
+
+        self.assertQueryUseIndex(line.select(line.id,
+                where=line.voucher == 1))
+        self.assertQueryUseIndex(line.select(line.id,
+                where=(line.pay_mode == 1)
+                & (line.pay_amount == Decimal('100'))
+                & (line.related_statement_line == Null)))
+
+    @with_transaction()
+    def test_open_items_fresh(self):
+        "Test open items follow posted invoices and reconciliations"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=2, seed=6)
+            invoice1, invoice2 = ledger['invoices']
+            party, = ledger['parties']
+
+            def open_lines():
+                voucher = Voucher(company=company, party=party,
+                    voucher_type='receipt', currency=company.currency,
+                    date=dt.date.today())
+                return {i['move_line'] for i in voucher.get_open_items()}
+
+            def lines_to_pay(*invoices):
+                return {l.id for i in Invoice.browse(invoices)
+                    for l in i.lines_to_pay}
+
+            self.assertEqual(open_lines(), lines_to_pay(invoice1, invoice2))
+
+            invoice3, = Invoice.copy([invoice2], default={
+                    'invoice_date': invoice2.invoice_date,
+                    })
+            Invoice.post([invoice3])
+            self.assertEqual(
+                open_lines(), lines_to_pay(invoice1, invoice2, invoice3))
+
+            voucher, = create_receipts(
+                ledger, [(invoice1, invoice1.total_amount)])
+            Voucher.post([voucher])
+            self.assertEqual(open_lines(), lines_to_pay(invoice2, invoice3))
+
+            Voucher.cancel([voucher])
+            self.assertEqual(
+                open_lines(), lines_to_pay(invoice1, invoice2, invoice3))
+
+    @with_transaction()
+    def test_open_items_cache(self):
+        "Test open items are cached until lines are reconciled"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, seed=6)
+            invoice, = ledger['invoices']
+            party, = ledger['parties']
+            line, = invoice.lines_to_pay
+            date = dt.date.today()
+            move = Move(period=Period.find(company, date=date), date=date,
+                journal=ledger['journal'], lines=[
+                    MoveLine(account=line.account, party=party,
+                        debit=line.credit, credit=line.debit),
+                    MoveLine(account=ledger['cash'],
+                        debit=line.debit, credit=line.credit),
+                    ])
+            move.save()
+            Move.post([move])
+            counterpart, = [l for l in move.lines if l.account.reconcile]
+
+            voucher = Voucher(company=company, party=party,
+                voucher_type='receipt', currency=company.currency,
+                date=dt.date.today())
+
+            Voucher.clear_open_items_cache()
+            stats = Voucher.open_items_cache_stats()
+            items = voucher.get_open_items()
+            self.assertEqual([i['move_line'] for i in items], [line.id])
+            self.assertEqual(
+                Voucher.open_items_cache_stats()['miss'], stats['miss'] + 1)
+            self.assertEqual(voucher.get_open_items(), items)
+            self.assertEqual(
+                Voucher.open_items_cache_stats()['hit'], stats['hit'] + 1)
+
+            MoveLine.reconcile([line, counterpart])
+            stats = Voucher.open_items_cache_stats()
+            self.assertEqual(voucher.get_open_items(), [])
+            self.assertEqual(
+                Voucher.open_items_cache_stats()['miss'], stats['miss'] + 1)
+
+    @with_transaction()
+    def test_open_items_domain(self):
+        "Test open items domain with filters"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        voucher = Voucher(voucher_type='receipt',
+            open_items_from_date=dt.date(2024, 1, 1),
+            open_items_maturity_date=dt.date(2024, 6, 30),
+            open_items_min_amount=Decimal('10'))
+
+        domain = voucher._get_open_items_domain()
+        self.assertIn(('account.type.receivable', '=', True), domain)
+        self.assertIn(['OR',
+                ('move.origin', 'like', 'account.invoice,%'),
+                ('move.origin', 'like', 'account.voucher,%'),
+                ('move.origin', 'like', 'account.statement,%'),
+                ], domain)
+        self.assertIn(('date', '>=', dt.date(2024, 1, 1)), domain)
+        self.assertIn(['OR',
+                ('maturity_date', '<=', dt.date(2024, 6, 30)),
+                ('maturity_date', '=', None),
+                ], domain)
+        self.assertIn(('id', 'in'), [c[:2] for c in domain])
+        self.assertNotIn(('date', '<=', None), domain)
+        self.assertNotIn('move.company',
+            [c[0] for c in domain if isinstance(c, tuple)])
+
+    @with_transaction()
+    def test_open_items_pages(self):
+        "Test open items are loaded in pages after the last loaded line"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        MoveLine = pool.get('account.move.line')
+
+        if not config.has_section('account_voucher_ar'):
+            config.add_section('account_voucher_ar')
+        config.set('account_voucher_ar', 'open_items_page_size', '2')
+        self.addCleanup(config.remove_option,
+            'account_voucher_ar', 'open_items_page_size')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(
+                company, parties=1, invoices=3, installments=2, seed=8)
+            party, = ledger['parties']
+            for order in ['date', 'maturity_date']:
+                voucher = Voucher(company=company, party=party,
+                    voucher_type='receipt', currency=company.currency,
+                    date=dt.date.today(), open_items_order=order)
+                expected = MoveLine.search(voucher._get_open_items_domain(),
+                    order=voucher._get_open_items_order())
+                self.assertEqual(len(expected), 6)
+
+                loaded, after = [], None
+                while True:
+                    page = voucher.get_open_items(after=after)
+                    if not page:
+                        break
+                    self.assertLessEqual(len(page), 2)
+                    loaded.extend(i['move_line'] for i in page)
+                    after = max(MoveLine.browse(loaded),
+                        key=voucher._get_open_items_key)
+                self.assertEqual(loaded, [l.id for l in expected])
+
+    @with_transaction()
+    def test_currency_converter(self):
+        "Test currency converter computes each rate once"
+        usd = create_currency('USD')
+        ars = create_currency('ARS')
+        add_currency_rate(usd, Decimal('1'))
+        add_currency_rate(ars, Decimal('800'))
+        converter = CurrencyConverter()
+
+        self.assertEqual(
+            converter.compute_many(
+                usd, [Decimal('1'), Decimal('2.5'), Decimal('0.01')], ars),
+            [Decimal('800.00'), Decimal('2000.00'), Decimal('8.00')])
+        self.assertEqual(
+            converter.compute(usd, Decimal('3'), ars), Decimal('2400.00'))
+        self.assertEqual(converter.lookups, 1)
+        self.assertEqual(
+            converter.compute(ars, Decimal('1000'), usd), Decimal('1.25'))
+        self.assertEqual(
+            converter.compute(usd, Decimal('1.111'), usd), Decimal('1.11'))
+        self.assertEqual(converter.lookups, 2)
+
+    @with_transaction()
+    def test_amount_residual_search_second_currency(self):
+        "Test searching amount residual matches the getter in second currency"
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=2,
+                currencies=[('EUR', Decimal('1.3'))], seed=1)
+            party, = ledger['parties']
+            invoice = ledger['invoices'][1]
+            currency = invoice.currency
+            self.assertNotEqual(currency, company.currency)
+            move_line, = invoice.lines_to_pay
+
+            voucher = Voucher(company=company, party=party,
+                voucher_type='receipt', journal=ledger['journal'],
+                currency=currency, date=dt.date.today())
+            voucher.add_lines()
+            amount = currency.round(invoice.total_amount / 3)
+            for line in voucher.lines:
+                if line.move_line == move_line:
+                    line.amount = amount
+            voucher.pay_lines = [PayModeLine(
+                    pay_mode=ledger['paymode'], pay_amount=amount)]
+            voucher.save()
+            Voucher.post([voucher])
+
+            residual = MoveLine(move_line.id).amount_residual
+            self.assertLess(residual, move_line.debit)
+            self.assertEqual(MoveLine.search([
+                        ('id', '=', move_line.id),
+                        ('amount_residual', '=', residual),
+                        ]), [move_line])
+
+    @with_transaction()
+    def test_get_move_origins_invalid_id(self):
+        "Test move origins without valid id are skipped"
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=3, seed=8)
+            invoice1, invoice2, invoice3 = ledger['invoices']
+            for invoice, origin in [
+                    (invoice2, 'account.invoice,'),
+                    (invoice3, 'account.invoice,foo'),
+                    ]:
+                cursor.execute(*move.update([move.origin], [origin],
+                        where=move.id == invoice.move.id))
+            lines = [l for i in ledger['invoices'] for l in i.lines_to_pay]
+
+            line, = invoice1.lines_to_pay
+            self.assertEqual(MoveLine.get_move_origins(lines), {
+                    line.id: ('account.invoice', invoice1.id)})
+
+    @with_transaction()
+    def test_open_items_totals(self):
+        "Test open items totals match the voucher lines in each currency"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=4,
+                currencies=[('EUR', Decimal('1.3'))], seed=7)
+            party, = ledger['parties']
+            invoice = ledger['invoices'][1]
+            currency = invoice.currency
+            voucher, = create_receipts(ledger, [
+                    (invoice, currency.round(invoice.total_amount / 3))])
+            Voucher.post([voucher])
+
+            for currency in ledger['currencies']:
+                voucher = Voucher(company=company, party=party,
+                    voucher_type='receipt', currency=currency,
+                    date=dt.date.today(), state='draft')
+                items = voucher.get_open_items()
+                self.assertEqual(voucher._get_open_items_totals(), (
+                        len(items),
+                        sum(i['amount_unreconciled'] for i in items)))
+
+                amounts = sorted(i['amount_unreconciled'] for i in items)
+                voucher.open_items_min_amount = amounts[-1]
+                self.assertEqual(
+                    sorted(i['amount_unreconciled']
+                        for i in voucher.get_open_items()),
+                    [a for a in amounts if a >= amounts[-1]])
+                voucher.open_items_min_amount = None
+                voucher.open_items_max_amount = amounts[0]
+                self.assertEqual(
+                    sorted(i['amount_unreconciled']
+                        for i in voucher.get_open_items()),
+                    [a for a in amounts if a <= amounts[0]])
+
+    @with_transaction()
+    def test_open_items_totals_once(self):
+        "Test open items count and total are computed once per change"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        MoveLine = pool.get('account.move.line')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=2, seed=7)
+            party, = ledger['parties']
+            voucher = Voucher(company=company, party=party,
+                voucher_type='receipt', currency=company.currency,
+                date=dt.date.today(), state='draft')
+            with patch.object(MoveLine, '_amount_residual_query',
+                    wraps=MoveLine._amount_residual_query) as query:
+                voucher.on_change_with(
+                    ['open_items_count', 'open_items_total'])
+            self.assertEqual(query.call_count, 1)
+
+    @with_transaction()
+    def test_post_batch(self):
+        "Test posting vouchers in batch creates the same moves as one by one"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, seed=1)
+            invoices = list(ledger['invoices'])
+            _, other_invoices = create_invoices(ledger, parties=2, seed=1)
+            groups = []
+            for invoice1, invoice2 in [invoices, other_invoices]:
+                half = invoice1.currency.round(invoice1.total_amount / 2)
+                groups.append(create_receipts(ledger, [
+                            (invoice1, half),
+                            (invoice1, invoice1.total_amount - half),
+                            (invoice2, invoice2.total_amount),
+                            ]))
+            one_by_one, batch = groups
+
+            for voucher in one_by_one:
+                Voucher.post([voucher])
+            Voucher.post(batch)
+
+            def moves(vouchers):
+                return [sorted(
+                        (l.account.id, l.debit, l.credit,
+                            bool(l.reconciliation))
+                        for l in v.move.lines)
+                    for v in Voucher.browse(vouchers)]
+
+            def reconciled(invoices):
+                return [
+                    all(l.reconciliation for l in i.lines_to_pay)
+                    for i in Invoice.browse(invoices)]
+
+            self.assertEqual(moves(batch), moves(one_by_one))
+            self.assertEqual(reconciled(invoices), [True, True])
+            self.assertEqual(reconciled(other_invoices), [True, True])
+
+    @with_transaction()
+    def test_deprecated_move_api(self):
+        "Test the deprecated move methods still post one voucher"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, seed=4)
+            invoice, = ledger['invoices']
+            voucher, = create_receipts(ledger, [
+                    (invoice, invoice.total_amount)])
+            line_to_pay, = invoice.lines_to_pay
+
+            lines, _ = voucher.get_reconcile_lines_for_amount(invoice,
+                invoice.total_amount, None, [line_to_pay.id])
+            self.assertEqual(lines, [])
+            lines, _ = voucher.get_reconcile_lines_for_amount(invoice,
+                invoice.total_amount, None, [])
+            self.assertEqual(lines, [line_to_pay])
+
+            with self.assertWarns(DeprecationWarning):
+                move_lines = voucher.prepare_move_lines()
+            self.assertIsInstance(move_lines, list)
+            self.assertEqual(Voucher(voucher.id).move.state, 'draft')
+            with self.assertWarns(DeprecationWarning):
+                self.assertTrue(voucher.create_move(move_lines))
+
+            voucher = Voucher(voucher.id)
+            self.assertEqual(voucher.move.state, 'posted')
+            self.assertEqual(len(voucher.move.lines), len(move_lines))
+            invoice = Invoice(invoice.id)
+            self.assertTrue(all(
+                    l.reconciliation for l in invoice.lines_to_pay))
+
+    @with_transaction()
+    def test_set_number(self):
+        "Test vouchers posted together are numbered in order without gap"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=4, seed=2)
+            vouchers = create_receipts(ledger, [
+                    (i, i.total_amount) for i in ledger['invoices']])
+            start_date = ledger['fiscalyear'].start_date
+            for voucher, days in zip(vouchers, [2, 0, 2, 1]):
+                voucher.date = start_date + dt.timedelta(days=days)
+            Voucher.save(vouchers)
+
+            Voucher.post(vouchers)
+
+            vouchers = sorted(
+                Voucher.browse(vouchers), key=lambda v: (v.date, v.id))
+            self.assertEqual(
+                [v.number for v in vouchers], ['1', '2', '3', '4'])
+
+            _, (invoice,) = create_invoices(ledger, seed=2)
+            voucher, = create_receipts(ledger, [
+                    (invoice, invoice.total_amount)])
+            voucher.set_number()
+            self.assertEqual(Voucher(voucher.id).number, '5')
+
+    @with_transaction()
+    def test_stored_amounts(self):
+        "Test stored amounts are updated when the lines are modified"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        Line = pool.get('account.voucher.line')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, seed=4)
+            invoice, = ledger['invoices']
+            total = invoice.total_amount
+            half = invoice.currency.round(total / 2)
+            voucher, = create_receipts(ledger, [(invoice, half)])
+
+            def amounts():
+                voucher = Voucher(voucher_id)
+                return (
+                    voucher.amount, voucher.amount_to_pay,
+                    voucher.amount_invoices)
+            voucher_id = voucher.id
+
+            self.assertEqual(amounts(), (half, total, half))
+
+            line, = voucher.lines
+            pay_line, = voucher.pay_lines
+            Line.write([line], {'amount': total})
+            self.assertEqual(amounts(), (half, total, total))
+
+            PayModeLine.write([pay_line], {'pay_amount': total})
+            self.assertEqual(amounts(), (total, total, total))
+
+            extra, = PayModeLine.create([{
+                        'voucher': voucher_id,
+                        'pay_mode': ledger['paymode'].id,
+                        'pay_amount': Decimal(10),
+                        }])
+            self.assertEqual(amounts(), (total + 10, total, total))
+
+            PayModeLine.delete([extra])
+            self.assertEqual(amounts(), (total, total, total))
+
+            Line.delete([line])
+            self.assertEqual(amounts(), (total, 0, 0))
+
+    @with_transaction()
+    def test_on_change_amounts(self):
+        "Test the amounts are computed once when the lines change"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        Line = pool.get('account.voucher.line')
+        LineCredits = pool.get('account.voucher.line.credits')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+
+        voucher = Voucher(
+            pay_lines=[PayModeLine(pay_amount=Decimal(10))],
+            lines_credits=[LineCredits(amount_original=Decimal(2))],
+            lines_debits=[],
+            lines=[Line(
+                    amount_unreconciled=Decimal(5), amount=Decimal(3))])
+        with patch.object(Voucher, '_get_amounts',
+                autospec=True, side_effect=Voucher._get_amounts) as get:
+            voucher.on_change_pay_lines()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(
+            (voucher.amount, voucher.amount_to_pay, voucher.amount_invoices),
+            (Decimal(12), Decimal(5), Decimal(3)))
+
+    @with_transaction()
+    def test_preview_post(self):
+        "Test preview post checks the amounts and describes the remainder"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        Warning = pool.get('res.user.warning')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, seed=9)
+            invoice, = ledger['invoices']
+            total = invoice.total_amount
+            half = invoice.currency.round(total / 2)
+            voucher, = create_receipts(ledger, [(invoice, half)])
+            pay_line, = voucher.pay_lines
+            PayModeLine.write([pay_line], {'pay_amount': total})
+            key = 'account_voucher_amount_greater@%s' % voucher.id
+            Warning.create([{
+                        'user': Transaction().user,
+                        'name': key,
+                        'always': False,
+                        }])
+
+            preview, = Voucher.preview_post([voucher])
+            self.assertEqual(preview['id'], voucher.id)
+            self.assertNotIn('error', preview)
+            self.assertEqual(len(preview['warnings']), 1)
+            self.assertIsNone(preview['writeoff'])
+            remainder = preview['remainder']
+            self.assertEqual(remainder['credit'], total - half)
+            self.assertEqual(remainder['description'], '')
+            self.assertIn(remainder, preview['move_lines'])
+            self.assertEqual(
+                Warning.search([('name', '=', key)], count=True), 1)
+            self.assertIsNone(Voucher(voucher.id).number)
+
+            PayModeLine.write([pay_line], {'pay_amount': half - 1})
+            preview, = Voucher.preview_post([voucher])
+            self.assertIn('error', preview)
+
+    @with_transaction()
+    def test_cancel(self):
+        "Test cancelling vouchers reverses their moves and reopens invoices"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('account.move')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, seed=3)
+            invoices = ledger['invoices']
+            vouchers = create_receipts(ledger, [
+                    (i, i.total_amount) for i in invoices])
+            Voucher.post(vouchers)
+
+            with patch.object(Move, 'copy', wraps=Move.copy) as copy:
+                Voucher.cancel(vouchers)
+            self.assertEqual(copy.call_count, 1)
+
+            for voucher in Voucher.browse(vouchers):
+                move, cancel_move = voucher.move, voucher.move_cancelled
+                self.assertEqual(voucher.state, 'cancelled')
+                self.assertEqual(cancel_move.state, 'posted')
+                self.assertEqual(cancel_move.origin, voucher)
+                self.assertEqual(cancel_move.date, move.date)
+                self.assertEqual(cancel_move.period, move.period)
+                self.assertEqual(
+                    sorted((l.account.id, l.debit, l.credit)
+                        for l in move.lines),
+                    sorted((l.account.id, l.credit, l.debit)
+                        for l in cancel_move.lines))
+                for line in move.lines + cancel_move.lines:
+                    if line.account.reconcile:
+                        self.assertTrue(line.reconciliation)
+            for invoice in Invoice.browse(invoices):
+                line, = invoice.lines_to_pay
+                self.assertIsNone(line.reconciliation)
+                self.assertEqual(line.amount_residual, line.debit)
+                self.assertEqual(invoice.payment_lines, ())
+                self.assertEqual(invoice.amount_to_pay, invoice.total_amount)
+
+    @with_transaction()
+    def test_mass_post_without_vouchers(self):
+        "Test mass post without vouchers"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        Cron = pool.get('ir.cron')
+
+        report = Voucher.mass_post([])
+        self.assertEqual(report['posted'], [])
+        self.assertEqual(report['errors'], {})
+        self.assertIn(
+            'account.voucher|mass_post_draft',
+            dict(Cron.method.selection))
+
+    @with_transaction()
+    def test_mass_post(self):
+        "Test mass post posts the vouchers of a chunk despite failing ones"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=4, seed=10)
+            vouchers = create_receipts(ledger, [
+                    (i, i.total_amount) for i in ledger['invoices']])
+            voucher1, voucher2, voucher3, voucher4 = vouchers
+            PayModeLine.delete(list(voucher2.pay_lines))
+            # The chunks are posted in their own transactions
+            Transaction().commit()
+
+            check_already_reconciled = Voucher.check_already_reconciled
+
+            def check(vouchers):
+                if voucher3 in vouchers:
+                    raise ValueError("Unexpected failure")
+                check_already_reconciled(vouchers)
+
+            with patch.object(
+                    Voucher, 'check_already_reconciled', side_effect=check):
+                report = Voucher.mass_post(
+                    [v.id for v in vouchers], chunk_size=4, processes=0)
+
+            self.assertEqual(
+                sorted(report['posted']), sorted([voucher1.id, voucher4.id]))
+            self.assertEqual(
+                set(report['errors']), {voucher2.id, voucher3.id})
+            self.assertTrue(report['errors'][voucher2.id])
+            self.assertEqual(
+                report['errors'][voucher3.id], "Unexpected failure")
+            self.assertEqual(Voucher.search([
+                        ('id', 'in', [v.id for v in vouchers]),
+                        ('state', '=', 'posted'),
+                        ], order=[('id', 'ASC')]), [voucher1, voucher4])
+
+    @with_transaction()
+    def test_mass_post_draft(self):
+        "Test the cron posts the draft vouchers until today"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, seed=11)
+            vouchers = create_receipts(ledger, [
+                    (i, i.total_amount) for i in ledger['invoices']])
+            tomorrow = dt.date.today() + dt.timedelta(days=1)
+            future, = create_receipts(ledger, [
+                    (i, i.total_amount) for i in ledger['invoices'][:1]],
+                date=tomorrow)
+            Transaction().commit()
+
+            report = Voucher.mass_post_draft()
+
+            self.assertLessEqual(
+                {v.id for v in vouchers}, set(report['posted']))
+            self.assertNotIn(future.id, report['posted'])
+            self.assertEqual(Voucher.search([
+                        ('id', 'in', [v.id for v in vouchers + [future]]),
+                        ('state', '=', 'posted'),
+                        ], order=[('id', 'ASC')]), vouchers)
+
+    @with_transaction(context={'voucher_timing': True})
+    def test_timing(self):
+        "Test timing records duration and queries"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        transaction = Transaction()
+        connection = transaction.connection
+
+        Voucher.clear_timing_stats()
+        with timing('test', [1, 2]):
+            cursor = transaction.connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+            self.assertEqual(next(cursor), (2,))
+        stats = Voucher.get_timing_stats()['test']
+
+        self.assertIs(transaction.connection, connection)
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['records'], 2)
+        self.assertEqual(stats['queries'], 2)
+        self.assertEqual(stats['queries_per_record'], 1)
+        self.assertGreaterEqual(stats['duration'], 0)
+        self.assertEqual(
+            stats['duration_per_record'], stats['duration'] / 2)
+
+    @with_transaction()
+    def test_report_views(self):
+        "Test the report views of vouchers"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        VoucherReport = pool.get('account.voucher', type='report')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=2)
+            party, = ledger['parties']
+            voucher = Voucher(company=company, party=party,
+                voucher_type='receipt', journal=ledger['journal'],
+                currency=company.currency, date=dt.date.today())
+            voucher.add_lines()
+            voucher.pay_lines = [PayModeLine(
+                    pay_mode=ledger['paymode'], pay_amount=Decimal(10))]
+            voucher.save()
+
+            view = VoucherReport.get_views([voucher])[voucher.id]
+
+            self.assertEqual(len(view.lines), 2)
+            self.assertEqual(
+                {l.origin.number for l in view.lines},
+                {i.number for i in ledger['invoices']})
+            self.assertEqual(
+                [l.amount_original_company for l in view.lines],
+                [l.amount_original for l in view.lines])
+            self.assertEqual(view.lines_credits, [])
+            self.assertEqual(
+                [(p.pay_mode_name, p.pay_amount) for p in view.pay_lines],
+                [('Cash', Decimal(10))])
+
+    @with_transaction()
+    def test_report_views_second_currency(self):
+        "Test report views give the original amounts in company currency"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        VoucherReport = pool.get('account.voucher', type='report')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=1, invoices=2,
+                currencies=[('EUR', Decimal(2))], seed=5)
+            party, = ledger['parties']
+            _, currency = ledger['currencies']
+            voucher = Voucher(company=company, party=party,
+                voucher_type='receipt', journal=ledger['journal'],
+                currency=currency, date=dt.date.today())
+            voucher.add_lines()
+            voucher.pay_lines = [PayModeLine(
+                    pay_mode=ledger['paymode'], pay_amount=Decimal(10))]
+            voucher.save()
+
+            view = VoucherReport.get_views([voucher])[voucher.id]
+
+            converter = CurrencyConverter()
+            lines = {l.id: l for l in voucher.lines}
+            self.assertEqual(len(view.lines), 2)
+            for line in view.lines:
+                self.assertEqual(line.amount_original_company,
+                    converter.compute(currency, line.amount_original,
+                        company.currency, date=voucher.date,
+                        currency_rate=lines[line.id].currency_rate))
+
+    @with_transaction()
+    def test_execute_batch(self):
+        "Test batch rendering of the voucher report"
+        pool = Pool()
+        Identifier = pool.get('party.identifier')
+        Voucher = pool.get('account.voucher')
+        VoucherReport = pool.get('account.voucher', type='report')
+
+        company = create_company()
+        Identifier(
+            party=company.party, type='ar_vat', code='30710158254').save()
+        company.party.iva_condition = 'responsable_inscripto'
+        company.party.save()
+        with set_company(company):
+            ledger = create_ledger(company, parties=3)
+            vouchers = [Voucher(company=company, party=party,
+                    voucher_type='receipt', journal=ledger['journal'],
+                    currency=company.currency, date=dt.date.today())
+                for party in ledger['parties']]
+            Voucher.save(vouchers)
+            ids = [v.id for v in vouchers]
+
+            def convert(report, data, **kwargs):
+                return 'pdf', b'%PDF-stub'
+
+            with patch.object(VoucherReport, 'convert', convert):
+                oext, content, _, _ = VoucherReport.execute_batch(
+                    ids, {}, output='zip', chunk_size=2)
+                self.assertEqual(oext, 'zip')
+                with zipfile.ZipFile(BytesIO(content)) as content_zip:
+                    self.assertEqual(
+                        content_zip.namelist(), ['%s.pdf' % i for i in ids])
+
+                oext, content, _, _ = VoucherReport.execute_batch(
+                    ids, {}, output='pdf', chunk_size=5)
+                self.assertEqual((oext, content), ('pdf', b'%PDF-stub'))
+
+    @unittest.skipIf(PdfWriter is None, "pypdf is not installed")
+    @with_transaction()
+    def test_execute_batch_merge(self):
+        "Test batch rendering merges the PDF of the chunks"
+        pool = Pool()
+        Identifier = pool.get('party.identifier')
+        Voucher = pool.get('account.voucher')
+        VoucherReport = pool.get('account.voucher', type='report')
+
+        company = create_company()
+        Identifier(
+            party=company.party, type='ar_vat', code='30710158254').save()
+        company.party.iva_condition = 'responsable_inscripto'
+        company.party.save()
+        with set_company(company):
+            ledger = create_ledger(company, parties=3)
+            vouchers = [Voucher(company=company, party=party,
+                    voucher_type='receipt', journal=ledger['journal'],
+                    currency=company.currency, date=dt.date.today())
+                for party in ledger['parties']]
+            Voucher.save(vouchers)
+            ids = [v.id for v in vouchers]
+
+            def convert(report, data, **kwargs):
+                writer = PdfWriter()
+                writer.add_blank_page(width=595, height=842)
+                content = BytesIO()
+                writer.write(content)
+                return 'pdf', content.getvalue()
+
+            with patch.object(VoucherReport, 'convert', convert):
+                oext, content, _, _ = VoucherReport.execute_batch(
+                    ids, {}, output='pdf', chunk_size=1)
+
+            self.assertEqual(oext, 'pdf')
+            self.assertEqual(len(PdfReader(BytesIO(content)).pages), 3)
+
+    @with_transaction()
+    def test_report_company_header(self):
+        "Test the company header of the voucher report"
+        pool = Pool()
+        Address = pool.get('party.address')
+        Company = pool.get('company.company')
+        Identifier = pool.get('party.identifier')
+        VoucherReport = pool.get('account.voucher', type='report')
+
+        company = create_company()
+        Identifier(
+            party=company.party, type='ar_vat', code='30710158254').save()
+        company.party.iva_condition = 'responsable_inscripto'
+        company.party.save()
+
+        header = VoucherReport.get_company_header(company)
+        self.assertEqual(header.name, company.party.full_name)
+        self.assertEqual(header.vat_number, '30-71015825-4')
+        self.assertEqual(
+            header.iva_condition,
+            VoucherReport.get_iva_condition(company.party))
+
+        Address.create([{
+                    'party': company.party.id,
+                    'street': "Main Street",
+                    }])
+        header = VoucherReport.get_company_header(Company(company.id))
+        self.assertIn("Main Street", header.address)
+
+    @with_transaction()
+    def test_statement_match_paymode_lines(self):
+        "Test matching statement lines with pay mode lines"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        StatementJournal = pool.get('account.statement.journal')
+        Statement = pool.get('account.statement')
+        StatementLine = pool.get('account.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, invoices=0)
+            party1, party2 = ledger['parties']
+            today = dt.date.today()
+            journal = StatementJournal(name="Cash",
+                journal=ledger['journal'], account=ledger['cash'],
+                currency=company.currency, company=company,
+                validation='balance')
+            journal.save()
+            paymode = ledger['paymode']
+            paymode.statement_reconcile = True
+            paymode.statement_journal = journal
+            paymode.save()
+
+            vouchers = []
+            for party, amount, days in [
+                    (party1, Decimal(100), 5),
+                    (party2, Decimal(100), 0),
+                    (party1, Decimal(50), 0),
+                    ]:
+                vouchers.append(Voucher(company=company, party=party,
+                        voucher_type='receipt', journal=ledger['journal'],
+                        currency=company.currency,
+                        date=today - dt.timedelta(days=days),
+                        pay_lines=[PayModeLine(
+                                pay_mode=paymode, pay_amount=amount)]))
+            Voucher.save(vouchers)
+            Voucher.write(vouchers, {'state': 'posted'})
+            (pay1,), (pay2,), (pay3,) = [v.pay_lines for v in vouchers]
+
+            lines = []
+            for number, amount, party in [
+                    ('1', Decimal(100), None),
+                    ('2', Decimal(100), party1),
+                    ('3', Decimal(50), party2),
+                    ('4', Decimal(-100), None),
+                    ]:
+                lines.append(StatementLine(number=number, date=today,
+                        amount=amount, party=party,
+                        account=ledger['revenue']))
+            statement = Statement(name="Statement", journal=journal,
+                company=company, date=today, start_balance=Decimal(0),
+                end_balance=Decimal(150), lines=lines)
+            statement.save()
+            line1, line2, line3, line4 = statement.lines
+
+            result = Statement.match_paymode_lines([statement])
+
+            self.assertEqual(result, [{
+                        'id': statement.id,
+                        'matched': [
+                            (line1.id, pay2.id), (line2.id, pay1.id)],
+                        'ambiguous': [(line1.id, [pay2.id, pay1.id])],
+                        'unmatched': [line3.id, line4.id],
+                        }])
+            line1, line2 = StatementLine.browse([line1, line2])
+            self.assertEqual(line1.related_to, pay2)
+            self.assertEqual(line1.party, party2)
+            self.assertEqual(line1.account, ledger['cash'])
+            self.assertEqual(line2.related_to, pay1)
+            self.assertEqual(
+                PayModeLine(pay1.id).related_statement_line, line2)
+
+            index, _ = Statement._get_paymode_index(
+                [company.id], [journal.id], [Decimal(50)])
+            self.assertEqual(list(index.values()), [
+                    [(pay3.id, party1.id, today, ledger['cash'].id)]])
+            index, _ = Statement._get_paymode_index(
+                [company.id + 1], [journal.id], [Decimal(50)])
+            self.assertEqual(index, {})
+
+    @with_transaction()
+    def test_statement_line_write_paymodes(self):
+        "Test writing statement lines updates all the pay mode lines"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        StatementJournal = pool.get('account.statement.journal')
+        Statement = pool.get('account.statement')
+        StatementLine = pool.get('account.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, invoices=0)
+            today = dt.date.today()
+            journal = StatementJournal(name="Cash",
+                journal=ledger['journal'], account=ledger['cash'],
+                currency=company.currency, company=company,
+                validation='balance')
+            journal.save()
+            paymode = ledger['paymode']
+            paymode.statement_reconcile = True
+            paymode.statement_journal = journal
+            paymode.save()
+
+            vouchers = [Voucher(company=company, party=party,
+                    voucher_type='receipt', journal=ledger['journal'],
+                    currency=company.currency, date=today,
+                    pay_lines=[PayModeLine(
+                            pay_mode=paymode, pay_amount=Decimal(10))])
+                for party in ledger['parties']]
+            Voucher.save(vouchers)
+            Voucher.write(vouchers, {'state': 'posted'})
+            (pay1,), (pay2,) = [v.pay_lines for v in vouchers]
+
+            statement = Statement(name="Statement", journal=journal,
+                company=company, date=today, start_balance=Decimal(0),
+                end_balance=Decimal(20), lines=[
+                    StatementLine(number=str(i), date=today,
+                        amount=Decimal(10), account=ledger['revenue'])
+                    for i in range(2)])
+            statement.save()
+            line1, line2 = statement.lines
+
+            StatementLine.write(
+                [line1], {'related_to': str(pay1)},
+                [line2], {'related_to': str(pay2)})
+            self.assertEqual(
+                [p.related_statement_line for p in PayModeLine.browse(
+                        [pay1, pay2])],
+                [line1, line2])
+
+            StatementLine.write([line1], {'related_to': str(pay2)},
+                [line2], {'related_to': None})
+            self.assertEqual(
+                [p.related_statement_line for p in PayModeLine.browse(
+                        [pay1, pay2])],
+                [None, line1])
+
+            StatementLine.write([line1], {'related_to': None})
+            self.assertEqual(
+                [p.related_statement_line for p in PayModeLine.browse(
+                        [pay1, pay2])],
+                [None, None])
+
+    @with_transaction()
+    def test_get_reference_query_count(self):
+        "Test get_reference queries do not grow with the lines"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Journal = pool.get('account.journal')
+        Voucher = pool.get('account.voucher')
+        VoucherLine = pool.get('account.voucher.line')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Party")
+            party.save()
+            journal, = Journal.search([('type', '=', 'cash')], limit=1)
+
+            def create(size):
+                voucher = Voucher(party=party, journal=journal,
+                    voucher_type='receipt', currency=company.currency,
+                    lines=[VoucherLine(name=str(i), amount=Decimal(0),
+                            line_type='dr') for i in range(size)])
+                voucher.save()
+                return VoucherLine.browse(voucher.lines)
+
+            self.assertQueryCountBounded(create,
+                lambda lines: VoucherLine.get_reference(lines, 'reference'),
+                per_slice=1)
+
+    @with_transaction()
+    def test_search_reference(self):
+        "Test searching lines on the reference of their invoice"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        VoucherLine = pool.get('account.voucher.line')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=2, seed=5)
+            invoice1, invoice2 = ledger['invoices']
+            Invoice.write([invoice1], {'reference': 'REF'})
+            voucher1, voucher2 = create_receipts(ledger, [
+                    (invoice1, invoice1.total_amount),
+                    (invoice2, invoice2.total_amount)])
+            line1, = voucher1.lines
+            line2, = voucher2.lines
+            line3, = VoucherLine.create([{
+                        'voucher': voucher1.id,
+                        'name': "Without move line",
+                        'amount': Decimal(0),
+                        'line_type': 'dr',
+                        }])
+
+            def search(operator, value):
+                return set(VoucherLine.search(
+                        [('reference', operator, value)]))
+
+            self.assertEqual(search('=', 'REF'), {line1})
+            self.assertEqual(search('=', None), {line2, line3})
+            self.assertEqual(search('!=', None), {line1})
+            self.assertEqual(
+                search('in', ['REF', None]), {line1, line2, line3})
+            self.assertEqual(search('not in', [None]), {line1})
+            self.assertEqual(
+                VoucherLine.get_reference([line1, line2, line3], 'reference'),
+                {line1.id: 'REF', line2.id: None, line3.id: None})
+
+    @with_transaction()
+    def test_add_lines_query_count(self):
+        "Test add_lines queries do not grow with the open items"
+        pool = Pool()
+        Voucher = pool.get('account.voucher')
+
+        company = create_company()
+        with set_company(company):
+            ledger = create_ledger(company, parties=0)
+
+            def create(size):
+                (party,), _ = create_invoices(ledger, invoices=size)
+                return Voucher(company=company, party=party,
+                    voucher_type='receipt', journal=ledger['journal'],
+                    currency=company.currency, date=dt.date.today())
+
+            def add_lines(voucher):
+                voucher.add_lines()
+                self.assertTrue(voucher.lines)
+
+            self.assertQueryCountBounded(
+                create, add_lines, per_slice=15, bound=10)
+
+    @with_transaction()
+    def test_update_paymode_lines_query_count(self):
+        "Test update_paymode_lines queries do not grow with the lines"
+        pool = Pool()
+        PayMode = pool.get('account.voucher.paymode')
+        PayModeLine = pool.get('account.voucher.line.paymode')
+        StatementLine = pool.get('account.statement.line')
+
+        company = create_company()
+        with set_company(company):
+            paymode = PayMode(name="Cash")
+            paymode.save()
+
+            def create(size):
+                return PayModeLine.create([{
+                            'pay_mode': paymode.id,
+                            'pay_amount': Decimal(i),
+                            } for i in range(size)])
+
+            self.assertQueryCountBounded(create,
+                lambda lines: StatementLine.update_paymode_lines(
+                    dict.fromkeys(map(int, lines))),
+                per_slice=5, bound=5)
+
+    @with_transaction()
+    def test_check_voucher_sequences(self):
+        "Test voucher sequences can not be shared by fiscal years"
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+
+        company = create_company()
+        with set_company(company):
+            fiscalyear = set_voucher_sequences(get_fiscalyear(
+                    company, today=dt.date(2000, 1, 1)))
+            fiscalyear.save()
+            fiscalyear.check_voucher_sequences()
+
+            other = set_voucher_sequences(get_fiscalyear(
+                    company, today=dt.date(2001, 1, 1)))
+            other.payment_sequence = fiscalyear.payment_sequence
+            with self.assertRaises(UserError):
+                FiscalYear.save([other])
+
+    @with_transaction()
+    def test_check_years_voucher_sequences_query_count(self):
+        "Test check_years_voucher_sequences queries do not grow with years"
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+
+        company = create_company()
+        with set_company(company):
+            years = []
+
+            def create(size):
+                fiscalyears = []
+                for i in range(len(years), len(years) + size):
+                    fiscalyears.append(set_voucher_sequences(get_fiscalyear(
+                                company, today=dt.date(1000 + i, 1, 1))))
+                FiscalYear.save(fiscalyears)
+                years.extend(fiscalyears)
+                return FiscalYear.browse(fiscalyears)
+
+            self.assertQueryCountBounded(
+                create, FiscalYear.check_years_voucher_sequences,
+                per_slice=8, bound=4)
+
 
 del ModuleTestCase